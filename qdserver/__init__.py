@@ -1,6 +1,8 @@
+import threading
 import traceback
 
 from pyramid.config import Configurator
+from pyramid.events import ContextFound
 from pyramid.authentication import BasicAuthAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.response import Response
@@ -8,7 +10,14 @@ from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated, forget
 from pyramid.view import forbidden_view_config, view_config
 from pyramid.httpexceptions import HTTPUnauthorized
 
-from .models import init_db
+from .cache import IdentityCache, LRUCache
+from .database import LazyConnection
+from .errors import UserError
+from .instrumentation import QueryInstrumentation, set_current_route
+from .models import init_db, check_schema_version
+from .preferred import load_preferred_sources
+from .rendering import json_renderer_factory
+from .schema import install_reload_handler, reload_bindings
 
 
 def forbidden_view(request):
@@ -27,6 +36,12 @@ def error_view(e, request):
     return response
 
 
+def user_error_view(e, request):
+    response = Response(str(e))
+    response.status_int = 400
+    return response
+
+
 def check_credentials(username, password, request):
     """Always allows everything"""
     return []
@@ -41,19 +56,47 @@ class Root:
 def main(settings):
     """Create and return a WSGI application."""
 
-    config = Configurator()
+    config = Configurator(settings=settings)
     config.registry.engine = init_db(settings)
+    check_schema_version(config.registry.engine)
+    config.registry.autocommit_engine = config.registry.engine.execution_options(
+        isolation_level="AUTOCOMMIT"
+    )
+    config.registry.id_cache = IdentityCache(
+        int(settings.get("qdserver.id_cache_size", 100000))
+    )
+    config.registry.plan_cache = LRUCache(
+        int(settings.get("qdserver.plan_cache_size", 1000))
+    )
+    # Long-polling /changes holds a thread and a connection, see qdserver.changes
+    config.registry.change_waiters = threading.BoundedSemaphore(
+        int(settings.get("qdserver.max_change_waiters", 1))
+    )
+    config.registry.preferred_sources = load_preferred_sources(
+        config.registry.engine
+    )
+    config.registry.instrumentation = QueryInstrumentation(
+        float(settings.get("qdserver.slow_query_threshold", 1.0))
+    )
+    config.registry.instrumentation.install(config.registry.engine)
+    reload_bindings(config.registry)
+    install_reload_handler(config.registry)
 
     def db(request):
-        connection = request.registry.engine.connect()
-        transaction = connection.begin()
+        # Read-only requests run in autocommit mode, without an explicit
+        # transaction. Either way, no connection is checked out until the
+        # first query is actually executed.
+        if request.method in ("GET", "HEAD"):
+            connection = LazyConnection(
+                request.registry.autocommit_engine, autocommit=True
+            )
+        else:
+            connection = LazyConnection(
+                request.registry.engine, id_cache=request.registry.id_cache
+            )
 
         def cleanup(request):
-            if request.exception is not None:
-                transaction.rollback()
-            else:
-                transaction.commit()
-            connection.close()
+            connection.finish(commit=request.exception is None)
 
         request.add_finished_callback(cleanup)
 
@@ -61,6 +104,12 @@ def main(settings):
 
     config.add_request_method(db, reify=True)
 
+    config.add_renderer("json", json_renderer_factory)
+
+    # Measure request and query latencies
+    config.add_subscriber(set_current_route, ContextFound)
+    config.add_tween("qdserver.instrumentation.instrumentation_tween_factory")
+
     # Configure authentication / authorization
     authn_policy = BasicAuthAuthenticationPolicy(check_credentials)
     config.set_authentication_policy(authn_policy)
@@ -69,12 +118,18 @@ def main(settings):
     config.add_forbidden_view(forbidden_view)
 
     config.add_view(view=error_view, context=Exception, renderer="json")
+    config.add_view(view=user_error_view, context=UserError, renderer="json")
 
     config.add_static_view(name="static", path="../../queryduck-web/static")
 
+    config.add_route("get_metrics", "/metrics", request_method="GET")
+    config.add_route("get_query_advice", "/query/advice", request_method="GET")
+    config.add_route("get_changes", "/changes", request_method="GET")
+
     config.add_route("post_query", "/{target}/query", request_method="POST")
     config.add_route("get_query", "/{target}/query", request_method="GET")
     config.add_route("get_statements", "/statements", request_method="GET")
+    config.add_route("export_statements", "/statements/export", request_method="GET")
     config.add_route(
         "submit_transaction", "/statements/transaction", request_method="POST"
     )
@@ -98,6 +153,16 @@ def main(settings):
         "/volumes/{volume_reference}/files",
         request_method="POST",
     )
+    config.add_route(
+        "list_volume_orphans",
+        "/volumes/{volume_reference}/orphans",
+        request_method="GET",
+    )
+    config.add_route(
+        "get_volume_digest",
+        "/volumes/{volume_reference}/digest",
+        request_method="GET",
+    )
     config.add_route(
         "get_volume_file",
         "/volumes/{volume_reference}/files/{file_path}",
@@ -105,6 +170,7 @@ def main(settings):
     )
 
     config.scan(".controllers")
+    config.scan(".changes")
     config.scan(".transaction.controllers")
     config.scan(".storage.controllers")
 
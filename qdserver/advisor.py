@@ -0,0 +1,48 @@
+"""Report which indexes the query shapes in the plan cache would use.
+
+Every shape is replayed with EXPLAIN, using the parameters it was first
+executed with, and the scans in its plan are summarized.
+"""
+
+from .utility import Explain
+
+
+def plan_nodes(plan):
+    """Yield every node in an EXPLAIN (FORMAT JSON) plan tree."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def summarize_plan(plan):
+    indexes = set()
+    index_only = set()
+    seq_scans = set()
+    for node in plan_nodes(plan):
+        if "Index Name" in node:
+            indexes.add(node["Index Name"])
+            if node["Node Type"] == "Index Only Scan":
+                index_only.add(node["Index Name"])
+        elif node["Node Type"] == "Seq Scan":
+            seq_scans.add(node["Relation Name"])
+    return {
+        "total_cost": plan["Total Cost"],
+        "indexes": sorted(indexes),
+        "index_only": sorted(index_only),
+        "seq_scans": sorted(seq_scans),
+    }
+
+
+def advise(db, plan_cache):
+    """EXPLAIN every cached query shape on `db`, most recently used first."""
+    report = []
+    for shape, entry in reversed(plan_cache.items()):
+        plan = (
+            db.execution_options(query_label="advisor")
+            .execute(Explain(entry.select), entry.params)
+            .scalar()
+        )
+        summary = summarize_plan(plan[0]["Plan"])
+        summary["sql"] = str(entry.compiled)
+        report.append(summary)
+    return report
@@ -0,0 +1,224 @@
+"""Asyncio serving mode for the read-only query, statement and file routes.
+
+make_app() returns an ASGI application that runs its queries on asyncpg, so
+a single process can keep many slow queries in flight at once. Everything
+else, including creating statements, is served by the WSGI application.
+"""
+
+import logging
+import re
+import time
+
+from urllib.parse import parse_qsl
+
+import asyncpg
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import select
+from webob.multidict import MultiDict
+
+from queryduck.query import request_params_to_query
+from queryduck.serialization import serialize, deserialize
+
+from ..cache import IdentityCache, LRUCache
+from ..controllers import StatementController
+from ..errors import SchemaVersionError, UserError
+from ..instrumentation import QueryInstrumentation
+from ..models import SCHEMA_VERSION, schema_version_table, volume_table
+from ..preferred import select_preferred_sources
+from ..rendering import dumps
+from ..storage.controllers import StorageController
+from .database import AsyncConnection
+from .repository import AsyncPGRepository
+
+
+log = logging.getLogger(__name__)
+
+
+# The same route names and patterns as in the WSGI application
+ROUTES = (
+    ("get_query", "GET", r"/(?P<target>[^/]+)/query"),
+    ("post_query", "POST", r"/(?P<target>[^/]+)/query"),
+    ("get_statements", "GET", r"/statements"),
+    ("list_volume_files", "GET", r"/volumes/(?P<volume_reference>[^/]+)/files"),
+)
+
+
+class AsyncRequest:
+    """The parts of a Pyramid request that the async views use."""
+
+    def __init__(self, scope, body, matchdict):
+        self.method = scope["method"]
+        self.matchdict = matchdict
+        self.GET = MultiDict(
+            parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        )
+        if self.method == "POST":
+            self.POST = MultiDict(
+                parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+            )
+        else:
+            self.POST = MultiDict()
+
+
+class AsyncApplication:
+    """ASGI application for the routes that only read from the database."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.id_cache = IdentityCache(
+            int(settings.get("qdserver.id_cache_size", 100000))
+        )
+        self.plan_cache = LRUCache(int(settings.get("qdserver.plan_cache_size", 1000)))
+        self.instrumentation = QueryInstrumentation(
+            float(settings.get("qdserver.slow_query_threshold", 1.0))
+        )
+        self.preferred_sources = frozenset()
+        self.db = None
+        self.routes = [
+            (name, method, re.compile(pattern + "$"))
+            for name, method, pattern in ROUTES
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.db.pool.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        url = make_url(self.settings["sqlalchemy.url"])
+        url.drivername = "postgresql"
+        pool_size = int(self.settings.get("qdserver.async_pool_size", 100))
+        pool = await asyncpg.create_pool(
+            str(url), min_size=min(10, pool_size), max_size=pool_size
+        )
+        self.db = AsyncConnection(pool, self.instrumentation)
+
+        version = await self.db.scalar(select([schema_version_table.c.version]))
+        if version != SCHEMA_VERSION:
+            raise SchemaVersionError(
+                "Database schema version is {}, expected {}. "
+                "Run `python -m qdserver.migrate` first.".format(
+                    version, SCHEMA_VERSION
+                )
+            )
+        rows = await self.db.execute(select_preferred_sources())
+        self.preferred_sources = frozenset(tuple(row) for row in rows)
+
+    async def handle(self, scope, receive, send):
+        start = time.perf_counter()
+        for name, method, pattern in self.routes:
+            match = pattern.match(scope["path"])
+            if match is not None and method == scope["method"]:
+                break
+        else:
+            await self.respond(send, 404, b"Not Found")
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        request = AsyncRequest(scope, body, match.groupdict())
+        try:
+            result = await getattr(self, name)(request)
+        except UserError as e:
+            await self.respond(send, 400, str(e).encode("utf-8"))
+        except Exception:
+            log.exception("Error while handling %s", name)
+            await self.respond(send, 500, b"Something went wrong")
+        else:
+            await self.respond(send, 200, dumps(result), "application/json")
+        finally:
+            self.instrumentation.observe_request(name, time.perf_counter() - start)
+
+    @staticmethod
+    async def respond(send, status, body, content_type="text/plain"):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", content_type.encode("latin-1"))],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    def repository(self):
+        return AsyncPGRepository(
+            self.db,
+            id_cache=self.id_cache,
+            plan_cache=self.plan_cache,
+            preferred_sources=self.preferred_sources,
+        )
+
+    ### View methods ###
+
+    async def get_query(self, request):
+        return await self._run_query(request, request.GET.items())
+
+    async def post_query(self, request):
+        return await self._run_query(request, request.POST.items())
+
+    async def get_statements(self, request):
+        repo = self.repository()
+        if "after" in request.GET:
+            after = repo.unique_add(deserialize(request.GET["after"]))
+        else:
+            after = None
+        quads = await repo.get_all_statements(after=after)
+        return {
+            "statements": [[serialize(e) for e in q] for q in quads],
+        }
+
+    async def list_volume_files(self, request):
+        reference = request.matchdict["volume_reference"]
+        s = select([volume_table]).where(volume_table.c.reference == reference)
+        volume = (await self.db.execute(s))[0]
+        s, limit = StorageController.select_volume_files(
+            volume[volume_table.c.id], request.GET
+        )
+        rows = await self.db.execute(s, label="volume files")
+        return {
+            "results": [StorageController.file_row_to_dict(r) for r in rows],
+            "limit": limit,
+        }
+
+    ### Worker methods ###
+
+    async def _run_query(self, request, params):
+        repo = self.repository()
+        params, options = StatementController.split_options(params)
+        query = request_params_to_query(
+            params,
+            request.matchdict["target"],
+            lambda ref: repo.unique_add(deserialize(ref)),
+        )
+        values, more, next_cursor, statements, files = await repo.run_query(
+            query, options["cursor"]
+        )
+        result = StatementController.query_result(
+            values, more, next_cursor, statements, files
+        )
+        if options["estimate"]:
+            result["estimated_total"] = await repo.estimate_result_count(query)
+        return result
+
+
+def make_app(settings):
+    """Create and return an ASGI application."""
+    return AsyncApplication(settings)
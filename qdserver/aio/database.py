@@ -0,0 +1,139 @@
+import time
+
+from functools import partial
+
+from sqlalchemy import util
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql.base import PGCompiler, PGDialect
+from sqlalchemy.types import TypeDecorator
+
+
+class _NativeUUID(UUID):
+    """UUID that is left to asyncpg, which handles uuid.UUID objects itself."""
+
+    def bind_processor(self, dialect):
+        return None
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
+class AsyncPGCompiler(PGCompiler):
+    """Number bind parameters the way asyncpg expects them: $1, $2, ...
+
+    SQLAlchemy's numeric paramstyle takes care of the positions, only the
+    template differs from its `:1`. Expanding IN parameters never occur:
+    in_() with a list of values gets a parameter per value, and lists that
+    are bound as one parameter are arrays, see any_of and array_placeholder.
+    """
+
+    def bindparam_string(self, name, **kw):
+        super().bindparam_string(name, **kw)
+        return "$[_POSITION]"
+
+
+class AsyncPGDialect(PGDialect):
+    statement_compiler = AsyncPGCompiler
+    colspecs = util.update_copy(PGDialect.colspecs, {UUID: _NativeUUID})
+
+    def __init__(self, **kwargs):
+        super().__init__(paramstyle="numeric", **kwargs)
+
+
+_dialect = AsyncPGDialect()
+
+
+class AsyncStatement:
+    """A SQLAlchemy Core construct, compiled once for use with asyncpg."""
+
+    def __init__(self, statement):
+        compiled = statement.compile(dialect=_dialect)
+        self.compiled = compiled
+        self.sql = compiled.string
+        self.bind_processors = compiled._bind_processors
+        # Result columns can be looked up by position, name or Column object
+        self.columns = {}
+        # asyncpg decodes the built-in types itself, custom types remain
+        self.result_processors = []
+        for position, (keyname, name, objects, type_) in enumerate(
+            compiled._result_columns
+        ):
+            self.columns.setdefault(keyname, position)
+            for obj in objects:
+                self.columns.setdefault(obj, position)
+            if isinstance(type_, TypeDecorator):
+                processor = partial(type_.process_result_value, dialect=_dialect)
+                self.result_processors.append((position, processor))
+
+    def __str__(self):
+        return self.sql
+
+    def render(self, params=None):
+        """Return the SQL and its positional arguments, bind processors applied."""
+        values = self.compiled.construct_params(params or {})
+        args = []
+        for name in self.compiled.positiontup:
+            value = values[name]
+            processor = self.bind_processors.get(name)
+            args.append(processor(value) if processor is not None else value)
+        return self.sql, args
+
+    def process_record(self, record):
+        if not self.result_processors:
+            return record
+        values = list(record)
+        for position, processor in self.result_processors:
+            values[position] = processor(values[position])
+        return values
+
+
+class Row:
+    """Read-only row that can be indexed like a SQLAlchemy RowProxy."""
+
+    __slots__ = ("_record", "_columns")
+
+    def __init__(self, record, columns):
+        self._record = record
+        self._columns = columns
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._record[key]
+        return self._record[self._columns[key]]
+
+    def __iter__(self):
+        return iter(self._record)
+
+    def __len__(self):
+        return len(self._record)
+
+
+class AsyncConnection:
+    """Execute SQLAlchemy Core constructs on a pool of asyncpg connections.
+
+    Every statement runs on its own pooled connection, in autocommit mode, so
+    this is only meant for read-only requests.
+    """
+
+    def __init__(self, pool, instrumentation=None):
+        self.pool = pool
+        self.instrumentation = instrumentation
+
+    async def execute(self, statement, params=None, label="untitled"):
+        if not isinstance(statement, AsyncStatement):
+            statement = AsyncStatement(statement)
+        sql, args = statement.render(params)
+
+        start = time.perf_counter()
+        async with self.pool.acquire() as connection:
+            records = await connection.fetch(sql, *args)
+        if self.instrumentation is not None:
+            duration = time.perf_counter() - start
+            self.instrumentation.observe_query(label, duration, len(records))
+        return [
+            Row(statement.process_record(r), statement.columns) for r in records
+        ]
+
+    async def scalar(self, statement, params=None, label="untitled"):
+        rows = await self.execute(statement, params, label)
+        return rows[0][0] if rows else None
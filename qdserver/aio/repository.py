@@ -0,0 +1,82 @@
+import json
+
+from queryduck.types import Blob, File, Statement
+
+from ..models import blob_table, statement_table
+from ..repository import FILE_BATCH_SIZE, PGRepository
+from ..utility import LOOKUP_BATCH_SIZE, RowDecoder, chunked
+from .database import AsyncStatement
+
+
+class AsyncPGRepository(PGRepository):
+    """Read-only counterpart of PGRepository on an AsyncConnection.
+
+    Queries are constructed by the same methods as in PGRepository, only the
+    methods that execute them are coroutines here.
+    """
+
+    def _compile(self, db_select):
+        return AsyncStatement(db_select)
+
+    async def _batched_select(self, make_select, keys, size, label):
+        rows = []
+        for chunk in chunked(keys, size):
+            rows.extend(await self.db.execute(make_select(chunk), label=label))
+        return rows
+
+    async def fill_ids(self, values):
+        statements = [v for v in values if type(v) == Statement]
+        await self._fill_table_ids(statements, statement_table, "statements")
+        blobs = [v for v in values if type(v) == Blob]
+        await self._fill_table_ids(blobs, blob_table, "blobs")
+        files = [v for v in values if type(v) == File]
+        await self.fill_file_blobs(files)
+
+    async def _fill_table_ids(self, values, table, kind):
+        cache = getattr(self.id_cache, kind) if self.id_cache is not None else None
+        if cache is not None:
+            id_map = cache.get_many({v.handle for v in values})
+        else:
+            id_map = {}
+        uncached = [v.handle for v in values if v.handle not in id_map]
+        if uncached:
+            rows = await self._batched_select(
+                lambda chunk: self.select_ids(table, chunk),
+                uncached,
+                LOOKUP_BATCH_SIZE,
+                "{} ids".format(kind[:-1]),
+            )
+            found = {u: i for i, u in rows}
+            # Outside of a transaction, we can only have seen committed rows
+            if cache is not None:
+                cache.set_many(found.items())
+            id_map.update(found)
+        for v in values:
+            v.id = id_map.get(v.handle, -1)
+
+    async def fill_file_blobs(self, files):
+        if not files:
+            return files
+        in_values = [(f.volume, f.path) for f in files]
+        rows = await self._batched_select(
+            self.select_file_blobs, in_values, FILE_BATCH_SIZE, "file blobs"
+        )
+        return self._set_file_blobs(files, rows)
+
+    async def get_all_statements(self, after=None):
+        s, entities = self.select_all_statements(after)
+        rows = await self.db.execute(s)
+        return self.process_result_quads(rows, RowDecoder(s, entities))
+
+    async def run_query(self, query, cursor=None):
+        await self.fill_ids(query.seen_values)
+        params = self._query_params(query, cursor)
+        statement, layout = self._compile_query(query, cursor, params)
+        rows = await self.db.execute(statement, params, "main result")
+        return self._process_query_rows(query, rows, layout)
+
+    async def estimate_result_count(self, query):
+        await self.fill_ids(query.seen_values)
+        explain, params = self._explain_query(query)
+        plan = json.loads(await self.db.scalar(explain, params, "estimate"))
+        return plan[0]["Plan"]["Plan Rows"]
@@ -0,0 +1,85 @@
+import datetime
+
+from sqlalchemy.sql import column, table
+
+
+# Batches with more rows than this are loaded with COPY instead of INSERT
+DEFAULT_BULK_THRESHOLD = 1000
+
+
+def encode_copy_value(value):
+    """Encode a single value for the text format of Postgres' COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class CopyReader:
+    """File-like object that encodes rows for COPY only as they are read."""
+
+    def __init__(self, rows):
+        self._lines = (
+            "\t".join([encode_copy_value(v) for v in row]) + "\n" for row in rows
+        )
+        self._parts = []
+        self._length = 0
+
+    def read(self, size=-1):
+        while size < 0 or self._length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            self._parts.append(line)
+            self._length += len(line)
+
+        data = "".join(self._parts)
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ""
+        self._parts = [rest] if rest else []
+        self._length = len(rest)
+        return data
+
+
+def copy_to_temp_table(db, name, columns, rows):
+    """Create a temporary table shaped like `columns` and COPY `rows` into it.
+
+    Returns a lightweight table() construct that can be used in further
+    queries. The table is dropped at the end of the transaction, or earlier
+    with `drop_temp_table`.
+    """
+    definitions = ", ".join(
+        "{} {}".format(c.name, c.type.compile(dialect=db.dialect)) for c in columns
+    )
+    db.execute(
+        "CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP".format(name, definitions)
+    )
+
+    column_names = ", ".join(c.name for c in columns)
+    cursor = db.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN".format(name, column_names), CopyReader(rows)
+        )
+    finally:
+        cursor.close()
+
+    return table(name, *[column(c.name) for c in columns])
+
+
+def drop_temp_table(db, name):
+    db.execute("DROP TABLE {}".format(name))
@@ -0,0 +1,116 @@
+import threading
+
+from collections import OrderedDict, namedtuple
+
+
+# What the plan cache keeps for every query shape
+PlanCacheEntry = namedtuple(
+    "PlanCacheEntry", ["compiled", "select", "params", "layout"]
+)
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used keys."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def get_many(self, keys):
+        """Return a dict with the cached values for those keys that are present."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    self._data.move_to_end(key)
+                except KeyError:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                found[key] = self._data[key]
+        return found
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        with self._lock:
+            for key, value in items:
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """Return a snapshot of the cached items, least recently used first."""
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class IdentityCache:
+    """Process-wide handle to id maps for Statements and Blobs.
+
+    Ids learned inside a transaction are staged on the connection and only
+    become visible to other requests once `publish` is called, after that
+    transaction has committed.
+    """
+
+    kinds = ("statements", "blobs")
+
+    def __init__(self, maxsize=100000):
+        self.statements = LRUCache(maxsize)
+        self.blobs = LRUCache(maxsize)
+
+    def stage(self, db, kind, id_map):
+        """Remember ids found or created on the `db` connection."""
+        if not id_map:
+            return
+        if not db.in_transaction():
+            # Outside of an explicit transaction, we can only see committed rows
+            getattr(self, kind).set_many(id_map.items())
+            return
+        pending = db.info.setdefault("qd_pending_ids", {})
+        pending.setdefault(kind, {}).update(id_map)
+
+    def stats(self):
+        return {kind: getattr(self, kind).stats() for kind in self.kinds}
+
+    def publish(self, conn):
+        """Make the ids staged on `conn` visible, after its commit succeeded."""
+        pending = conn.info.pop("qd_pending_ids", None)
+        if not pending:
+            return
+        for kind, id_map in pending.items():
+            getattr(self, kind).set_many(id_map.items())
+
+    def discard(self, conn):
+        """Forget the ids staged on `conn`, e.g. when its transaction failed."""
+        conn.info.pop("qd_pending_ids", None)
@@ -0,0 +1,312 @@
+"""Follow the changes to statements and files in the order they were made.
+
+Every write to a statement or file row stamps it with the id of the writing
+transaction, change_xid, and the next number of the change_seq sequence.
+Every deleted file leaves a row stamped the same way in file_deletion.
+
+Changes are read in (change_xid, change_seq) order, and only from
+transactions older than the oldest transaction that is still running. All of
+those have ended, so no change can appear later in between the changes that
+were already read. The token of the last change read is the `since` of the
+next read. A long-running transaction anywhere in the cluster holds back
+newer changes until it ends.
+
+Nothing else removes rows from file_deletion. Once every follower has read
+past a token, run `python -m qdserver.changes <token>` to prune the file
+deletions up to it. Followers that ask for changes since an older token are
+told to start over.
+"""
+
+import os
+import sys
+import time
+
+from heapq import merge
+from itertools import islice
+from selectors import DefaultSelector, EVENT_READ
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.response import Response
+from pyramid.view import view_config
+from sqlalchemy.sql import func, select
+from sqlalchemy.sql.expression import tuple_ as sqltuple
+
+from queryduck.serialization import serialize
+
+from .config import load_config, config_to_settings
+from .controllers import BaseController
+from .errors import UserError
+from .models import (
+    blob_table,
+    file_deletion_horizon_table,
+    file_deletion_table,
+    file_table,
+    init_db,
+    statement_table,
+    volume_table,
+)
+from .rendering import dumps
+from .repository import PGRepository
+from .storage.controllers import StorageController
+from .utility import CHANGE_CHANNEL, RowDecoder
+
+
+# Seconds between reads while waiting, even without notifications
+RECHECK_INTERVAL = 1.0
+
+
+def encode_change_token(key):
+    return "{}.{}".format(*key)
+
+
+def decode_change_token(token):
+    try:
+        xid, seq = token.split(".")
+        return int(xid), int(seq)
+    except ValueError:
+        raise UserError("Invalid change token: {}".format(token))
+
+
+def select_changes(s, table, since, horizon, limit):
+    """Restrict a select() to the changes of `table` after `since`, in order.
+
+    The select() needs to include the change_xid and change_seq columns.
+    """
+    key = sqltuple(table.c.change_xid, table.c.change_seq)
+    return (
+        s.where(key > sqltuple(*since))
+        .where(table.c.change_xid < horizon)
+        .order_by(table.c.change_xid, table.c.change_seq)
+        .limit(limit)
+    )
+
+
+def row_key(row, table):
+    return row[table.c.change_xid], row[table.c.change_seq]
+
+
+def select_statement_changes(connection, since, horizon, limit):
+    t = statement_table
+    s, entities = PGRepository.select_full_statements(t, blob_files=False)
+    s = select_changes(s.where(t.c.subject_id != None), t, since, horizon, limit)
+    db = connection.execution_options(query_label="statement changes")
+    rows = db.execute(s).fetchall()
+    quads = RowDecoder(s, entities).quads(rows)
+    return [
+        (row_key(row, t), "statement", [serialize(e) for e in quad])
+        for row, quad in zip(rows, quads)
+    ]
+
+
+def select_file_changes(connection, since, horizon, limit):
+    t = file_table
+    j = t.join(blob_table, blob_table.c.id == t.c.blob_id).join(
+        volume_table, volume_table.c.id == t.c.volume_id
+    )
+    s = select([t, blob_table.c.handle, volume_table.c.reference]).select_from(j)
+    s = select_changes(s, t, since, horizon, limit)
+    db = connection.execution_options(query_label="file changes")
+    changes = []
+    for row in db.execute(s):
+        f = StorageController.file_row_to_dict(row)
+        f["volume"] = row[volume_table.c.reference]
+        changes.append((row_key(row, t), "file", f))
+    return changes
+
+
+def select_file_deletions(connection, since, horizon, limit):
+    t = file_deletion_table
+    j = t.join(volume_table, volume_table.c.id == t.c.volume_id)
+    s = select([t, volume_table.c.reference]).select_from(j)
+    s = select_changes(s, t, since, horizon, limit)
+    db = connection.execution_options(query_label="file deletions")
+    return [
+        (
+            row_key(row, t),
+            "deleted_file",
+            {
+                "volume": row[volume_table.c.reference],
+                "path": os.fsdecode(row[t.c.path]),
+            },
+        )
+        for row in db.execute(s)
+    ]
+
+
+def select_pruned_until():
+    h = file_deletion_horizon_table
+    return select([h.c.change_xid, h.c.change_seq])
+
+
+def check_since(connection, since):
+    """Refuse a `since` from before the file deletions that were pruned."""
+    pruned_until = connection.execute(select_pruned_until()).first()
+    if pruned_until is not None and since < tuple(pruned_until):
+        raise UserError(
+            "Changes before {} are no longer available, start over without "
+            "since".format(encode_change_token(tuple(pruned_until)))
+        )
+
+
+def prune_file_deletions(engine, until):
+    """Delete the file deletions up to and including the token `until`.
+
+    Returns the number of file deletions that were deleted.
+    """
+    t = file_deletion_table
+    h = file_deletion_horizon_table
+    with engine.begin() as connection:
+        # Lock out other prunes, so the horizon only moves forward
+        connection.execute("LOCK TABLE {} IN EXCLUSIVE MODE".format(h.name))
+        pruned_until = connection.execute(select_pruned_until()).first()
+        if pruned_until is not None:
+            until = max(until, tuple(pruned_until))
+        connection.execute(h.delete())
+        connection.execute(h.insert().values(change_xid=until[0], change_seq=until[1]))
+        key = sqltuple(t.c.change_xid, t.c.change_seq)
+        result = connection.execute(t.delete().where(key <= sqltuple(*until)))
+    return result.rowcount
+
+
+def read_changes(connection, since, limit):
+    """Return up to `limit` (key, kind, value) tuples after `since`, in order.
+
+    The horizon and changes of all kinds are read from the same snapshot.
+    """
+    transaction = connection.begin()
+    try:
+        connection.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        horizon = connection.execute(
+            select([func.txid_snapshot_xmin(func.txid_current_snapshot())])
+        ).scalar()
+        changes = [
+            select_statement_changes(connection, since, horizon, limit),
+            select_file_changes(connection, since, horizon, limit),
+            select_file_deletions(connection, since, horizon, limit),
+        ]
+    finally:
+        transaction.rollback()
+    return list(islice(merge(*changes), limit))
+
+
+def wait_for_changes(dbapi_connection, timeout):
+    """Wait until a listening connection is notified of changes.
+
+    Returns False if there was no notification within `timeout` seconds.
+    """
+    if not dbapi_connection.notifies:
+        if timeout <= 0:
+            return False
+        with DefaultSelector() as selector:
+            selector.register(dbapi_connection, EVENT_READ)
+            if not selector.select(timeout):
+                return False
+        dbapi_connection.poll()
+    del dbapi_connection.notifies[:]
+    return True
+
+
+class ReleaseOnClose:
+    """Response body that calls `release` when the server is done with it.
+
+    The server closes a body even if it never started iterating it, while
+    the cleanup in a generator only runs once it has started.
+    """
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            self.app_iter.close()
+        finally:
+            self.release()
+
+
+class ChangeController(BaseController):
+
+    max_limit = 10000
+    max_wait = 60
+
+    @view_config(route_name="get_changes")
+    def get_changes(self):
+        """Stream the changes after `since` as newline delimited JSON.
+
+        Every line holds the `token` of a change and either a `statement`,
+        `file` or `deleted_file`. The last token is the `since` of the next
+        request. If there are no changes yet, `wait` is the number of
+        seconds to wait for them before returning an empty response. A
+        `since` from before the pruned file deletions is refused.
+
+        Waiting holds a thread and a database connection, so only a few
+        requests per process can wait at the same time. Others are answered
+        with a 503.
+        """
+        params = self.request.GET
+        since = decode_change_token(params["since"]) if "since" in params else (0, 0)
+        try:
+            limit = int(params.get("limit", 1000))
+            wait = float(params.get("wait", 0))
+        except ValueError:
+            raise UserError("Invalid limit or wait")
+        if limit < 1:
+            raise UserError("limit must be at least 1")
+        limit = min(limit, self.max_limit)
+        wait = min(max(wait, 0), self.max_wait)
+        if "since" in params:
+            check_since(self.request.db, since)
+
+        engine = self.request.registry.engine
+        app_iter = self._change_lines(engine, since, limit, wait)
+        if wait > 0:
+            waiters = self.request.registry.change_waiters
+            if not waiters.acquire(blocking=False):
+                response = HTTPServiceUnavailable("Too many waiting requests")
+                response.headers["Retry-After"] = "1"
+                return response
+            app_iter = ReleaseOnClose(app_iter, waiters.release)
+        return Response(app_iter=app_iter, content_type="application/x-ndjson")
+
+    @staticmethod
+    def _change_lines(engine, since, limit, wait):
+        """Encode changes on a connection of their own, like export_statements.
+
+        Listening starts before the first read, so that no change committed
+        in between can go unnoticed. Changes that were notified but are still
+        behind the horizon are picked up by reading again every
+        RECHECK_INTERVAL seconds.
+        """
+        connection = engine.connect()
+        try:
+            if wait > 0:
+                with connection.begin():
+                    connection.execute("LISTEN {}".format(CHANGE_CHANNEL))
+            dbapi_connection = connection.connection.connection
+            deadline = time.monotonic() + wait
+
+            changes = read_changes(connection, since, limit)
+            while not changes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait_for_changes(dbapi_connection, min(remaining, RECHECK_INTERVAL))
+                changes = read_changes(connection, since, limit)
+
+            for key, kind, value in changes:
+                yield dumps({"token": encode_change_token(key), kind: value}) + b"\n"
+        finally:
+            if wait > 0:
+                with connection.begin():
+                    connection.execute("UNLISTEN *")
+            connection.close()
+
+
+if __name__ == "__main__":
+    until = decode_change_token(sys.argv[1])
+    engine = init_db(config_to_settings(load_config(), statement_timeout=False))
+    count = prune_file_deletions(engine, until)
+    print("Pruned {} file deletions up to {}".format(count, sys.argv[1]))
@@ -0,0 +1,64 @@
+import os
+
+import yaml
+
+
+def load_config(conffile=None):
+    """Read config.yml from QDCONFIG or the default location."""
+    if conffile is None:
+        if "QDCONFIG" in os.environ:
+            conffile = os.environ["QDCONFIG"]
+        else:
+            conffile = os.path.expanduser("~/.config/queryduck/config.yml")
+
+    with open(conffile, "r") as f:
+        config = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    return config
+
+
+POOL_OPTIONS = (
+    "pool_size",
+    "max_overflow",
+    "pool_timeout",
+    "pool_recycle",
+    "pool_pre_ping",
+)
+
+
+def config_to_settings(config, statement_timeout=True):
+    """Translate the config.yml structure to the settings used by main().
+
+    Maintenance commands pass `statement_timeout=False`, as the limit for
+    request queries would cut their long-running statements short.
+    """
+    export = config.get("export", {})
+    cache = config.get("cache", {})
+    instrumentation = config.get("instrumentation", {})
+    ingest = config.get("ingest", {})
+    changes = config.get("changes", {})
+    schema = config.get("schema", {})
+    settings = {
+        "sqlalchemy.url": config["db"]["url"],
+        "sqlalchemy.echo": config["db"]["echo"],
+        "qdserver.export_page_size": export.get("page_size", 1000),
+        "qdserver.id_cache_size": cache.get("id_cache_size", 100000),
+        "qdserver.plan_cache_size": cache.get("plan_cache_size", 1000),
+        "qdserver.slow_query_threshold": instrumentation.get(
+            "slow_query_threshold", 1.0
+        ),
+        "qdserver.bulk_threshold": ingest.get("bulk_threshold", 1000),
+        "qdserver.async_pool_size": config["db"].get("async_pool_size", 100),
+        "qdserver.max_change_waiters": changes.get("max_waiters", 1),
+    }
+    if "path" in schema:
+        settings["qdserver.schema_path"] = schema["path"]
+    for option in POOL_OPTIONS:
+        if option in config["db"]:
+            settings["sqlalchemy." + option] = config["db"][option]
+    timeout = config["db"].get("statement_timeout", 0)
+    if statement_timeout and timeout:
+        # Postgres cancels any statement that runs longer, in milliseconds
+        settings["sqlalchemy.connect_args"] = {
+            "options": "-c statement_timeout={}".format(int(timeout * 1000))
+        }
+    return settings
@@ -1,7 +1,9 @@
 import base64
+import logging
 
 from uuid import uuid4
 
+from pyramid.response import Response
 from pyramid.view import view_config
 
 from queryduck.query import (
@@ -10,11 +12,19 @@ from queryduck.query import (
     request_params_to_query,
     element_classes,
 )
-from queryduck.types import Statement, Blob
+from queryduck.types import Statement
 from queryduck.serialization import serialize, deserialize
 from queryduck.utility import transform_doc
 
+from .advisor import advise
+from .bulk import DEFAULT_BULK_THRESHOLD
+from .errors import UserError
+from .rendering import dumps
 from .repository import PGRepository
+from .utility import encode_cursor, decode_cursor
+
+
+log = logging.getLogger(__name__)
 
 
 class BaseController(object):
@@ -29,10 +39,21 @@ class BaseController(object):
 class StatementController(BaseController):
     """Provide a limited but simplified way to fetch and save Statements"""
 
+    max_page_size = 10000
+
     def __init__(self, request):
         """Make relevant services available."""
         self.request = request
-        self.repo = PGRepository(self.request.db)
+        settings = self.request.registry.settings
+        self.repo = PGRepository(
+            self.request.db,
+            id_cache=self.request.registry.id_cache,
+            plan_cache=self.request.registry.plan_cache,
+            preferred_sources=self.request.registry.preferred_sources,
+            bulk_threshold=int(
+                settings.get("qdserver.bulk_threshold", DEFAULT_BULK_THRESHOLD)
+            ),
+        )
 
     ### View methods ###
 
@@ -72,83 +93,106 @@ class StatementController(BaseController):
         quads = self.repo.get_all_statements(after=after)
 
         result = {
-            "statements": [],
+            "statements": [[serialize(e) for e in q] for q in quads],
         }
 
-        for q in quads:
-            result["statements"].append([serialize(e) for e in q])
-
         return result
 
+    @view_config(route_name="export_statements")
+    def export_statements(self):
+        """Stream all statements as newline delimited JSON quads."""
+        if "after" in self.request.GET:
+            after = deserialize(self.request.GET["after"])
+        else:
+            after = None
+        settings = self.request.registry.settings
+        page_size = int(settings.get("qdserver.export_page_size", 1000))
+        if "page_size" in self.request.GET:
+            try:
+                page_size = int(self.request.GET["page_size"])
+            except ValueError:
+                raise UserError("Invalid page_size")
+            if page_size < 1:
+                raise UserError("page_size must be at least 1")
+            page_size = min(page_size, self.max_page_size)
+
+        app_iter = self._export_lines(self.request.registry.engine, after, page_size)
+        return Response(app_iter=app_iter, content_type="application/x-ndjson")
+
     @view_config(route_name="post_query", renderer="json")
     def post_query(self):
-        print("___")
-        print(self.request.text)
-        print("___")
-        query = request_params_to_query(
-            self.request.POST.items(),
-            self.request.matchdict["target"],
-            self.unique_deserialize,
-        )
-        query.show()
-        values, more = self.repo.get_results(query)
-        statements = self.repo.get_additional_statements(query, values)
-        blobs = []
-        for s in statements:
-            if s.triple and type(s.triple[2]) == Blob:
-                blobs.append(s.triple[2])
-        for v in values:
-            if type(v) == Blob:
-                blobs.append(v)
-        files = self.repo.get_blob_files(blobs)
-        print(
-            "Query results: {} primary, {} additional, {} files".format(
-                len(values), len(statements), len(files)
-            )
-        )
-        result = {
-            "references": [serialize(v) for v in values],
-            "statements": self.statements_to_dict(statements),
-            "files": self.serialize_files(files),
-            "more": more,
-        }
-        return result
+        return self._run_query(self.request.POST.items())
 
     @view_config(route_name="get_query", renderer="json")
     def get_query(self):
-        # target = self.repo.get_target_table(self.request.matchdict["target"])
+        return self._run_query(self.request.GET.items())
+
+    @view_config(route_name="get_metrics", renderer="json")
+    def get_metrics(self):
+        result = self.request.registry.instrumentation.to_dict()
+        result["identity_cache"] = self.request.registry.id_cache.stats()
+        result["plan_cache"] = self.request.registry.plan_cache.stats()
+        return result
+
+    @view_config(route_name="get_query_advice", renderer="json")
+    def get_query_advice(self):
+        """Show the indexes used by every query shape in the plan cache."""
+        return advise(self.request.db, self.request.registry.plan_cache)
+
+    ### Worker methods ###
+
+    def _run_query(self, params):
+        params, options = self.split_options(params)
         query = request_params_to_query(
-            self.request.GET.items(),
+            params,
             self.request.matchdict["target"],
             self.unique_deserialize,
         )
-        query.show()
-        values, more = self.repo.get_results(query)
-        statements = self.repo.get_additional_statements(query, values)
-        blobs = []
-        for s in statements:
-            if s.triple and type(s.triple[2]) == Blob:
-                blobs.append(s.triple[2])
-        for v in values:
-            if type(v) == Blob:
-                blobs.append(v)
-        files = self.repo.get_blob_files(blobs)
-        print(
-            "Query results: {} primary, {} additional, {} files".format(
-                len(values), len(statements), len(files)
-            )
+        if log.isEnabledFor(logging.DEBUG):
+            query.show()
+        values, more, next_cursor, statements, files = self.repo.run_query(
+            query, options["cursor"]
         )
-        result = {
+        result = self.query_result(values, more, next_cursor, statements, files)
+        if options["estimate"]:
+            result["estimated_total"] = self.repo.estimate_result_count(query)
+        return result
+
+    @staticmethod
+    def _export_lines(engine, after, page_size):
+        """Encode quads one line at a time on a connection of their own.
+
+        The request's own connection is released before the response body is
+        iterated, so the export has to manage its connection lifetime itself.
+        """
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            repo = PGRepository(connection)
+            for quad in repo.iter_all_statements(after=after, page_size=page_size):
+                yield dumps([serialize(e) for e in quad]) + b"\n"
+        finally:
+            transaction.rollback()
+            connection.close()
+
+    @classmethod
+    def query_result(cls, values, more, next_cursor, statements, files):
+        log.debug(
+            "Query results: %d primary, %d additional, %d files",
+            len(values),
+            len(statements),
+            len(files),
+        )
+        return {
             "references": [serialize(v) for v in values],
-            "statements": self.statements_to_dict(statements),
-            "files": self.serialize_files(files),
+            "statements": dict(cls.statement_items(statements)),
+            "files": cls.serialize_files(files),
             "more": more,
+            "cursor": encode_cursor(next_cursor) if more else None,
         }
-        return result
 
-    ### Worker methods ###
-
-    def serialize_files(self, files):
+    @staticmethod
+    def serialize_files(files):
         serialized_files = {}
         for blob, v in files.items():
             k = serialize(blob)
@@ -156,13 +200,17 @@ class StatementController(BaseController):
 
         return serialized_files
 
-    def statements_to_dict(self, statements):
-        statement_dict = {}
+    @staticmethod
+    def statement_items(statements):
+        """Yield every Statement with its values, each Statement only once."""
+        seen = set()
         for s in statements:
             if not s.triple or not s.triple[0]:
                 continue
-            statement_dict[serialize(s)] = [serialize(e) for e in s.triple]
-        return statement_dict
+            key = serialize(s)
+            if key not in seen:
+                seen.add(key)
+                yield key, [serialize(e) for e in s.triple]
 
     def unique_deserialize(self, ref):
         """Ensures there is only ever one instance of the same Statement present"""
@@ -196,6 +244,23 @@ class StatementController(BaseController):
 
     ### Helper methods ###
 
+    @staticmethod
+    def split_options(params):
+        """Separate the server side options from the query parameters."""
+        query_params = []
+        options = {
+            "cursor": None,
+            "estimate": False,
+        }
+        for k, v in params:
+            if k == "cursor":
+                options["cursor"] = decode_cursor(v)
+            elif k == "estimate":
+                options["estimate"] = v not in ("", "0", "false")
+            else:
+                query_params.append((k, v))
+        return query_params, options
+
     def _prepare_query(self, query):
         """Deserialize any values inside the query, and add database IDs."""
         values = []
@@ -0,0 +1,49 @@
+class LazyConnection:
+    """Stand-in for a Connection that is only checked out when first used.
+
+    Unless `autocommit` is set, a transaction is started as soon as the
+    underlying Connection is acquired, and ended by `finish()`. Ids staged
+    in `id_cache` during that transaction are published once it committed.
+    """
+
+    def __init__(self, engine, autocommit=False, id_cache=None):
+        self.engine = engine
+        self.autocommit = autocommit
+        self.id_cache = id_cache
+        self._connection = None
+        self._transaction = None
+
+    @property
+    def dialect(self):
+        return self.engine.dialect
+
+    def _acquire(self):
+        if self._connection is None:
+            connection = self.engine.connect()
+            if not self.autocommit:
+                self._transaction = connection.begin()
+            self._connection = connection
+        return self._connection
+
+    def __getattr__(self, name):
+        return getattr(self._acquire(), name)
+
+    def finish(self, commit=True):
+        """End the transaction, if any, and return the connection to the pool."""
+        if self._connection is None:
+            return
+        try:
+            if self._transaction is not None:
+                if commit:
+                    self._transaction.commit()
+                    # Only ids of rows that are committed can be shared
+                    if self.id_cache is not None:
+                        self.id_cache.publish(self._connection)
+                else:
+                    self._transaction.rollback()
+        finally:
+            if self.id_cache is not None:
+                self.id_cache.discard(self._connection)
+            self._connection.close()
+            self._connection = None
+            self._transaction = None
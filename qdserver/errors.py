@@ -3,3 +3,9 @@ class UserError(Exception):
 
 class TodoError(Exception):
     pass
+
+class QDValueError(Exception):
+    pass
+
+class SchemaVersionError(Exception):
+    pass
@@ -0,0 +1,115 @@
+"""Maintain partial indexes for the predicates with the most statements.
+
+Run as `python -m qdserver.hot_indexes` after changing
+`storage.hot_predicates` in config.yml. Each hot predicate gets its own
+partial indexes, restricted to `predicate_id = <id>`.
+
+Queries pass predicate ids as an array parameter, `predicate_id =
+ANY(CAST(:p AS INTEGER[]))`. Postgres can only use these indexes when it
+plans with the actual values. psycopg2 fills in parameters on the client,
+so for a query on a single hot predicate the planner sees a constant array
+with one element, which proves the index predicate. Queries on several
+predicates at once, and generic plans of prepared statements as used by the
+asyncpg server, fall back to the general indexes.
+"""
+
+from queryduck.serialization import deserialize
+
+from .config import load_config, config_to_settings
+from .models import OBJECT_COLUMNS, init_db, statement_table
+from .repository import PGRepository
+
+
+INDEX_PREFIX = "ix_statement_hot_"
+
+
+def resolve_predicates(engine, references):
+    """Look up the ids of the serialized predicate references."""
+    with engine.connect() as connection:
+        repo = PGRepository(connection)
+        predicates = [repo.unique_add(deserialize(r)) for r in references]
+        repo.fill_ids(predicates)
+    missing = [r for r, p in zip(references, predicates) if p.id == -1]
+    if missing:
+        raise ValueError("Unknown predicates: {}".format(", ".join(missing)))
+    return [p.id for p in predicates]
+
+
+def used_object_columns(connection, predicate_id):
+    """Return the object columns that have values for this predicate."""
+    columns = []
+    for object_type, column_name in enumerate(OBJECT_COLUMNS):
+        exists = connection.execute(
+            "SELECT EXISTS (SELECT 1 FROM statement "
+            "WHERE predicate_id = %(predicate_id)s "
+            "AND object_type = %(object_type)s)",
+            {"predicate_id": predicate_id, "object_type": object_type},
+        ).scalar()
+        if exists:
+            columns.append(column_name)
+    return columns
+
+
+def hot_predicate_indexes(connection, predicate_id):
+    """Return the definitions of the partial indexes for one predicate."""
+    prefix = "{}{}_".format(INDEX_PREFIX, predicate_id)
+    where = "predicate_id = {:d}".format(predicate_id)
+    indexes = {prefix + "subject_id": ("subject_id", where)}
+    for column_name in used_object_columns(connection, predicate_id):
+        indexes[prefix + column_name] = (
+            "{}, subject_id".format(column_name),
+            "{} AND {} IS NOT NULL".format(where, column_name),
+        )
+    return indexes
+
+
+def existing_hot_indexes(connection):
+    """Return the names of the hot indexes that exist, and which are valid.
+
+    A CREATE INDEX CONCURRENTLY that failed leaves an invalid index behind,
+    which is maintained on writes but never used.
+    """
+    rows = connection.execute(
+        "SELECT c.relname, i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = %(table)s::regclass AND c.relname LIKE %(prefix)s",
+        {"table": statement_table.name, "prefix": INDEX_PREFIX + "%"},
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+def sync_hot_predicate_indexes(engine, predicate_ids):
+    """Create the indexes for all hot predicates, and drop any others.
+
+    Indexes are created and dropped CONCURRENTLY, so the server can keep
+    running, but this can't happen inside a transaction.
+    """
+    autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+    with autocommit_engine.connect() as connection:
+        wanted = {}
+        for predicate_id in predicate_ids:
+            wanted.update(hot_predicate_indexes(connection, predicate_id))
+        existing = existing_hot_indexes(connection)
+
+        for name in sorted(existing.keys() - wanted.keys()):
+            print("Dropping index {} ...".format(name))
+            connection.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+        for name, (columns, where) in sorted(wanted.items()):
+            if existing.get(name):
+                continue
+            if name in existing:
+                print("Dropping invalid index {} ...".format(name))
+                connection.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+            print("Creating index {} ...".format(name))
+            connection.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} "
+                "ON statement ({}) WHERE {}".format(name, columns, where)
+            )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    engine = init_db(config_to_settings(config, statement_timeout=False))
+    references = config.get("storage", {}).get("hot_predicates", [])
+    sync_hot_predicate_indexes(engine, resolve_predicates(engine, references))
+    print("Indexes are in place for {} hot predicates".format(len(references)))
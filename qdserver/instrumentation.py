@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+log = logging.getLogger(__name__)
+
+# Name of the route being handled by the current thread, if any
+current_route = ContextVar("current_route", default=None)
+
+# Requests that matched no route are counted under this name, as JSON only
+# has string keys
+UNMATCHED_ROUTE = "<unmatched>"
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """Count observations in fixed latency buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            "le": list(self.buckets) + ["+Inf"],
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class QueryInstrumentation:
+    """Collect request and query timings.
+
+    Query timings come from SQLAlchemy's cursor events, so every statement
+    sent to Postgres is measured without the callers having to do anything.
+    Callers can pass a `query_label` execution option to tell queries apart.
+    """
+
+    def __init__(self, slow_query_threshold=1.0, max_slow_queries=100):
+        self.slow_query_threshold = slow_query_threshold
+        self.routes = defaultdict(Histogram)
+        self.queries = defaultdict(Histogram)
+        self.rows = defaultdict(int)
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self._lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def observe_request(self, route_name, duration):
+        with self._lock:
+            self.routes[route_name].observe(duration)
+
+    def observe_query(self, label, duration, rows):
+        with self._lock:
+            self.queries[label].observe(duration)
+            if rows > 0:
+                self.rows[label] += rows
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "routes": {k: v.to_dict() for k, v in self.routes.items()},
+                "queries": {
+                    k: dict(v.to_dict(), rows=self.rows[k])
+                    for k, v in self.queries.items()
+                },
+                "slow_query_threshold": self.slow_query_threshold,
+                "slow_queries": list(self.slow_queries),
+            }
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        context._qd_start = time.perf_counter()
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        duration = time.perf_counter() - context._qd_start
+        label = context.execution_options.get("query_label", "untitled")
+        route = current_route.get()
+        self.observe_query(label, duration, cursor.rowcount)
+
+        if duration >= self.slow_query_threshold:
+            self._capture_slow_query(
+                cursor, statement, parameters, label, route, duration
+            )
+
+    def _capture_slow_query(
+        self, cursor, statement, parameters, label, route, duration
+    ):
+        # Only slow queries pay for rendering the parameters into the SQL
+        if hasattr(cursor, "mogrify") and not isinstance(parameters, (list, tuple)):
+            sql = cursor.mogrify(statement, parameters).decode("utf-8", "replace")
+        else:
+            sql = statement
+        capture = {
+            "route": route,
+            "label": label,
+            "duration": duration,
+            "rows": cursor.rowcount,
+            "sql": sql,
+        }
+        with self._lock:
+            self.slow_queries.append(capture)
+        log.warning(
+            "Slow query %s on route %s took %.3f seconds", label, route, duration
+        )
+
+
+class RouteAppIter:
+    """Response body that is iterated with `current_route` set to its route.
+
+    Streamed bodies run their queries after the tween has returned, and the
+    server iterates them in the thread that handled the request.
+    """
+
+    def __init__(self, app_iter, route_name):
+        self.app_iter = app_iter
+        self.route_name = route_name
+
+    def __iter__(self):
+        current_route.set(self.route_name)
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            current_route.set(None)
+
+
+def instrumentation_tween_factory(handler, registry):
+    """Measure the latency of every request, per matched route."""
+    instrumentation = registry.instrumentation
+
+    def instrumentation_tween(request):
+        start = time.perf_counter()
+        try:
+            response = handler(request)
+        finally:
+            duration = time.perf_counter() - start
+            route = request.matched_route
+            name = route.name if route is not None else UNMATCHED_ROUTE
+            instrumentation.observe_request(name, duration)
+            current_route.set(None)
+        if not isinstance(response.app_iter, (list, tuple)):
+            response.app_iter = RouteAppIter(response.app_iter, name)
+        return response
+
+    return instrumentation_tween
+
+
+def set_current_route(event):
+    route = event.request.matched_route
+    current_route.set(route.name if route is not None else None)
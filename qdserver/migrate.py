@@ -0,0 +1,311 @@
+"""Create or upgrade the database schema.
+
+Run as `python -m qdserver.migrate` before (re)starting the server. The
+server itself only checks the schema version and never creates tables.
+"""
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import exists, func, literal_column, select
+
+from .config import load_config, config_to_settings
+from .models import (
+    OBJECT_COLUMNS,
+    SCHEMA_VERSION,
+    blob_table,
+    change_seq,
+    file_deletion_horizon_table,
+    file_deletion_table,
+    file_table,
+    init_db,
+    get_schema_version,
+    meta,
+    preferred_value_table,
+    preferred_value_source_table,
+    schema_version_table,
+    statement_table,
+    volume_digest_table,
+)
+from .storage.digest import select_bucket_digests, sql_file_digest, sql_path_bucket
+from .utility import object_type_case
+
+
+# Functions that upgrade the schema from version n - 1 to version n
+migrations: dict = {}
+
+# Number of rows that non-transactional migrations update at once
+BACKFILL_BATCH_SIZE = 50000
+
+
+def migration(version, transactional=True):
+    """Register a migration.
+
+    Migrations that are not `transactional` get a connection in autocommit
+    mode, and have to be safe to run again if they fail halfway.
+    """
+
+    def register(f):
+        f.transactional = transactional
+        migrations[version] = f
+        return f
+
+    return register
+
+
+def create_index_concurrently(connection, index):
+    """Build `index` without blocking writes to its table.
+
+    Needs a connection in autocommit mode. Any index with the same name, like
+    an invalid one left behind by a failed attempt, is dropped first.
+    """
+    connection.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(index.name))
+    options = index.dialect_options["postgresql"]
+    options["concurrently"] = True
+    try:
+        index.create(connection)
+    finally:
+        options["concurrently"] = False
+
+
+def backfill(connection, table, update):
+    """Run `update` on all rows of `table`, in batches that commit one by one.
+
+    Row locks are only held for one batch at a time. `update` has to skip
+    the rows it already updated, as it runs once more on the whole table at
+    the end, for rows with lower ids that were committed late.
+    """
+    start = 0
+    while True:
+        # Servers of the previous version keep inserting rows meanwhile
+        max_id = connection.execute(select([func.max(table.c.id)])).scalar() or 0
+        if start > max_id:
+            break
+        for start in range(start, max_id + 1, BACKFILL_BATCH_SIZE):
+            connection.execute(
+                update.where(table.c.id >= start).where(
+                    table.c.id < start + BACKFILL_BATCH_SIZE
+                )
+            )
+        start += BACKFILL_BATCH_SIZE
+    connection.execute(update)
+
+
+def set_not_null(connection, table, column):
+    """Make `column` NOT NULL without blocking the table while checking it.
+
+    A validated CHECK constraint lets SET NOT NULL skip its own scan of the
+    table under an exclusive lock, from PostgreSQL 12 on.
+    """
+    names = {"table": table.name, "column": column}
+    names["check"] = "{table}_{column}_not_null".format(**names)
+    for statement in (
+        "ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}",
+        "ALTER TABLE {table} ADD CONSTRAINT {check} "
+        "CHECK ({column} IS NOT NULL) NOT VALID",
+        "ALTER TABLE {table} VALIDATE CONSTRAINT {check}",
+        "ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL",
+        "ALTER TABLE {table} DROP CONSTRAINT {check}",
+    ):
+        connection.execute(statement.format(**names))
+
+
+def create_object_type_trigger(connection):
+    """Compute object_type from the object columns whenever a row is written.
+
+    Servers of the previous version write statements without object_type,
+    until they are restarted. The new servers set it themselves.
+    """
+    new = {name: literal_column("NEW.{}".format(name)) for name in OBJECT_COLUMNS}
+    case = object_type_case(new).compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    connection.execute(
+        "CREATE OR REPLACE FUNCTION statement_object_type() RETURNS trigger AS $$ "
+        "BEGIN NEW.object_type := {}; RETURN NEW; END "
+        "$$ LANGUAGE plpgsql".format(case)
+    )
+    connection.execute("DROP TRIGGER IF EXISTS statement_object_type ON statement")
+    connection.execute(
+        "CREATE TRIGGER statement_object_type "
+        "BEFORE INSERT OR UPDATE OF {} ON statement FOR EACH ROW "
+        "EXECUTE PROCEDURE statement_object_type()".format(", ".join(OBJECT_COLUMNS))
+    )
+
+
+@migration(2, transactional=False)
+def add_composite_statement_indexes(connection):
+    # Nine indexes on the largest table, so don't block writes while building
+    names = ["ix_statement_subject_id_predicate_id"] + [
+        "ix_statement_predicate_id_{}".format(c) for c in OBJECT_COLUMNS
+    ]
+    for index in statement_table.indexes:
+        if index.name in names:
+            create_index_concurrently(connection, index)
+    # (subject_id, predicate_id) covers everything the old index did
+    connection.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_statement_subject_id")
+
+
+@migration(3)
+def add_preferred_value_tables(connection):
+    preferred_value_table.create(connection)
+    preferred_value_source_table.create(connection)
+
+
+@migration(4, transactional=False)
+def add_object_type(connection):
+    connection.execute(
+        "ALTER TABLE statement ADD COLUMN IF NOT EXISTS object_type smallint"
+    )
+    create_object_type_trigger(connection)
+    t = statement_table
+    backfill(
+        connection,
+        t,
+        t.update()
+        .where(t.c.object_type == None)
+        .values(object_type=object_type_case(t.c)),
+    )
+    for index in statement_table.indexes:
+        if index.name == "ix_statement_predicate_id_object_type":
+            create_index_concurrently(connection, index)
+
+
+@migration(5, transactional=False)
+def add_volume_digests(connection):
+    connection.execute("ALTER TABLE file ADD COLUMN IF NOT EXISTS digest bigint")
+    connection.execute("ALTER TABLE file ADD COLUMN IF NOT EXISTS bucket integer")
+    t = file_table
+    handle = (
+        select([blob_table.c.handle]).where(blob_table.c.id == t.c.blob_id).as_scalar()
+    )
+    backfill(
+        connection,
+        t,
+        t.update()
+        .where(t.c.bucket == None)
+        .values(
+            digest=sql_file_digest(t.c.path, handle, t.c.size, t.c.mtime),
+            bucket=sql_path_bucket(t.c.path),
+        ),
+    )
+    for index in file_table.indexes:
+        if index.name == "ix_file_volume_id_bucket":
+            create_index_concurrently(connection, index)
+    volume_digest_table.create(connection, checkfirst=True)
+    # Sums of all files, so start over if an earlier attempt got this far
+    connection.execute(volume_digest_table.delete())
+    connection.execute(
+        volume_digest_table.insert().from_select(
+            ["volume_id", "bucket", "digest", "count"],
+            select_bucket_digests(),
+        )
+    )
+
+
+@migration(6, transactional=False)
+def add_change_sequence(connection):
+    change_seq.create(connection, checkfirst=True)
+    for t in (statement_table, file_table):
+        # Volatile defaults would rewrite the whole table while adding the
+        # columns, so they're set afterwards and existing rows are backfilled
+        connection.execute(
+            "ALTER TABLE {} "
+            "ADD COLUMN IF NOT EXISTS change_xid bigint, "
+            "ADD COLUMN IF NOT EXISTS change_seq bigint".format(t.name)
+        )
+        connection.execute(
+            "ALTER TABLE {} "
+            "ALTER COLUMN change_xid SET DEFAULT txid_current(), "
+            "ALTER COLUMN change_seq SET DEFAULT nextval('change_seq')".format(t.name)
+        )
+        backfill(
+            connection,
+            t,
+            t.update()
+            .where(t.c.change_xid == None)
+            .values(change_xid=func.txid_current(), change_seq=change_seq.next_value()),
+        )
+        set_not_null(connection, t, "change_xid")
+        set_not_null(connection, t, "change_seq")
+        for index in t.indexes:
+            if index.name == "ix_{}_change_xid_change_seq".format(t.name):
+                create_index_concurrently(connection, index)
+    file_deletion_table.create(connection, checkfirst=True)
+
+
+@migration(7)
+def add_blob_has_statements(connection):
+    connection.execute(
+        "ALTER TABLE blob ADD COLUMN has_statements boolean NOT NULL DEFAULT false"
+    )
+    with_statements = exists().where(
+        statement_table.c.object_blob_id == blob_table.c.id
+    )
+    connection.execute(
+        blob_table.update().where(with_statements).values(has_statements=True)
+    )
+    names = ["ix_blob_id_handle_without_statements", "ix_file_volume_id_path_blob_id"]
+    for index in blob_table.indexes | file_table.indexes:
+        if index.name in names:
+            index.create(connection)
+
+
+@migration(8)
+def add_file_deletion_horizon(connection):
+    file_deletion_horizon_table.create(connection)
+
+
+def set_schema_version(connection, version):
+    connection.execute(schema_version_table.delete())
+    connection.execute(schema_version_table.insert().values(version=version))
+
+
+def initialize(engine):
+    """Create the complete schema in an empty database."""
+    with engine.begin() as connection:
+        meta.create_all(connection)
+        create_object_type_trigger(connection)
+        set_schema_version(connection, SCHEMA_VERSION)
+
+
+def upgrade(engine, version):
+    """Apply every migration after `version`, each in its own transaction."""
+    for next_version in range(version + 1, SCHEMA_VERSION + 1):
+        print("Upgrading schema to version {} ...".format(next_version))
+        f = migrations[next_version]
+        if f.transactional:
+            with engine.begin() as connection:
+                f(connection)
+                set_schema_version(connection, next_version)
+            continue
+
+        autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+        with autocommit_engine.connect() as connection:
+            f(connection)
+        with engine.begin() as connection:
+            set_schema_version(connection, next_version)
+
+
+def migrate(engine):
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+        has_statements = engine.dialect.has_table(connection, statement_table.name)
+
+    if version is None and not has_statements:
+        print("Initializing schema version {} ...".format(SCHEMA_VERSION))
+        initialize(engine)
+        return
+
+    if version is None:
+        # Databases created before schema versioning existed are at version 1
+        with engine.begin() as connection:
+            schema_version_table.create(connection, checkfirst=True)
+            set_schema_version(connection, 1)
+        version = 1
+
+    upgrade(engine, version)
+
+
+if __name__ == "__main__":
+    engine = init_db(config_to_settings(load_config(), statement_timeout=False))
+    migrate(engine)
+    print("Schema is at version {}".format(SCHEMA_VERSION))
@@ -10,6 +10,8 @@ from sqlalchemy import (
     Index,
     Integer,
     Numeric,
+    Sequence,
+    SmallInteger,
     String,
 )
 
@@ -17,22 +19,89 @@ from sqlalchemy.dialects.postgresql import (
     BYTEA,
     UUID,
 )
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.sql import false, func, not_, select
+
+from .errors import SchemaVersionError
+
+
+# Increase this whenever a migration is added to qdserver.migrate
+SCHEMA_VERSION = 8
 
 
 def init_db(settings):
     engine = engine_from_config(settings)
-    meta.create_all(engine)
     return engine
 
 
+def get_schema_version(connection):
+    """Return the schema version of the database, or None if it has none."""
+    try:
+        return connection.execute(select([schema_version_table.c.version])).scalar()
+    except ProgrammingError:
+        return None
+
+
+def check_schema_version(engine):
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+    if version != SCHEMA_VERSION:
+        raise SchemaVersionError(
+            "Database schema version is {}, expected {}. "
+            "Run `python -m qdserver.migrate` first.".format(version, SCHEMA_VERSION)
+        )
+
+
 meta = MetaData()
 
+# The value of statement.object_type is the index of the column holding the
+# object in this tuple, so new columns can only ever be appended
+OBJECT_COLUMNS = (
+    "object_statement_id",
+    "object_blob_id",
+    "object_integer",
+    "object_decimal",
+    "object_string",
+    "object_boolean",
+    "object_datetime",
+    "object_bytes",
+)
+
+schema_version_table = Table(
+    "schema_version",
+    meta,
+    Column("version", Integer, nullable=False),
+)
+
+# Every write to a statement or file row takes the next number, see
+# qdserver.changes
+change_seq = Sequence("change_seq", metadata=meta)
+
+
+def change_columns():
+    """Return the columns that place every write of a row in the change feed."""
+    return [
+        Column(
+            "change_xid",
+            BigInteger,
+            server_default=func.txid_current(),
+            nullable=False,
+        ),
+        Column(
+            "change_seq",
+            BigInteger,
+            server_default=change_seq.next_value(),
+            nullable=False,
+        ),
+    ]
+
+
 statement_table = Table(
     "statement",
     meta,
     Column("id", Integer, primary_key=True),
     Column("handle", UUID(as_uuid=True), index=True, unique=True, nullable=False),
-    Column("subject_id", Integer, ForeignKey("statement.id"), index=True),
+    Column("subject_id", Integer, ForeignKey("statement.id")),
     Column("predicate_id", Integer, ForeignKey("statement.id"), index=True),
     Column("object_statement_id", Integer, ForeignKey("statement.id")),
     Column("object_blob_id", Integer, ForeignKey("blob.id")),
@@ -42,6 +111,13 @@ statement_table = Table(
     Column("object_boolean", Boolean),
     Column("object_datetime", DateTime),
     Column("object_bytes", BYTEA),
+    Column("object_type", SmallInteger),
+    *change_columns(),
+)
+Index(
+    "ix_statement_change_xid_change_seq",
+    statement_table.c.change_xid,
+    statement_table.c.change_seq,
 )
 Index(
     "ix_statement_object_statement_id",
@@ -83,6 +159,45 @@ Index(
     statement_table.c.object_bytes,
     postgresql_where=statement_table.c.object_bytes != None,
 )
+# Every hop of a query joins on subject and predicate, then looks at one object
+Index(
+    "ix_statement_subject_id_predicate_id",
+    statement_table.c.subject_id,
+    statement_table.c.predicate_id,
+)
+for column_name in OBJECT_COLUMNS:
+    Index(
+        "ix_statement_predicate_id_{}".format(column_name),
+        statement_table.c.predicate_id,
+        statement_table.c[column_name],
+        postgresql_where=statement_table.c[column_name] != None,
+    )
+Index(
+    "ix_statement_predicate_id_object_type",
+    statement_table.c.predicate_id,
+    statement_table.c.object_type,
+)
+
+
+# The preferred Statement per subject, for (predicate, value type, keyword)
+# combinations that are listed in preferred_value_source
+preferred_value_table = Table(
+    "preferred_value",
+    meta,
+    Column("predicate_id", Integer, ForeignKey("statement.id"), primary_key=True),
+    Column("vtype", String, primary_key=True),
+    Column("keyword", String, primary_key=True),
+    Column("subject_id", Integer, ForeignKey("statement.id"), primary_key=True),
+    Column("statement_id", Integer, ForeignKey("statement.id"), index=True),
+)
+
+preferred_value_source_table = Table(
+    "preferred_value_source",
+    meta,
+    Column("predicate_id", Integer, ForeignKey("statement.id"), primary_key=True),
+    Column("vtype", String, primary_key=True),
+    Column("keyword", String, primary_key=True),
+)
 
 
 volume_table = Table(
@@ -98,6 +213,15 @@ blob_table = Table(
     meta,
     Column("id", Integer, primary_key=True),
     Column("handle", BYTEA, index=True, unique=True, nullable=False),
+    # Whether any statement has the blob as its object
+    Column("has_statements", Boolean, nullable=False, server_default=false()),
+)
+# Blobs without statements, with what listing them needs from the blob
+Index(
+    "ix_blob_id_handle_without_statements",
+    blob_table.c.id,
+    blob_table.c.handle,
+    postgresql_where=not_(blob_table.c.has_statements),
 )
 
 file_table = Table(
@@ -110,5 +234,47 @@ file_table = Table(
     Column("size", BigInteger, index=True),
     Column("mtime", DateTime, index=True),
     Column("lastverify", DateTime, index=True),
+    # See qdserver.storage.digest
+    Column("digest", BigInteger),
+    Column("bucket", Integer),
+    *change_columns(),
     Index("ix_volume_path", "volume_id", "path", unique=True),
+    Index("ix_file_volume_id_bucket", "volume_id", "bucket"),
+    Index("ix_file_change_xid_change_seq", "change_xid", "change_seq"),
+    # Lets files without statements be listed with index-only scans
+    Index("ix_file_volume_id_path_blob_id", "volume_id", "path", "blob_id"),
+)
+
+# The sum of the file digests in every non-empty bucket of a volume
+volume_digest_table = Table(
+    "volume_digest",
+    meta,
+    Column("volume_id", Integer, ForeignKey("volume.id"), primary_key=True),
+    Column("bucket", Integer, primary_key=True),
+    Column("digest", Numeric, nullable=False),
+    Column("count", Integer, nullable=False),
+)
+
+# Files that were deleted, so that following changes can see them go
+file_deletion_table = Table(
+    "file_deletion",
+    meta,
+    Column("id", Integer, primary_key=True),
+    *change_columns(),
+    Column(
+        "volume_id",
+        Integer,
+        ForeignKey("volume.id", ondelete="CASCADE"),
+        nullable=False,
+    ),
+    Column("path", BYTEA, nullable=False),
+    Index("ix_file_deletion_change_xid_change_seq", "change_xid", "change_seq"),
+)
+
+# The change token up to which file_deletion was pruned, if it ever was
+file_deletion_horizon_table = Table(
+    "file_deletion_horizon",
+    meta,
+    Column("change_xid", BigInteger, nullable=False),
+    Column("change_seq", BigInteger, nullable=False),
 )
@@ -0,0 +1,57 @@
+"""Build the table of preferred values for configured predicates.
+
+Run as `python -m qdserver.preferred` after changing `prefer.preferred_values`
+in config.yml, and restart the server afterwards. From then on, the server
+keeps the table up to date whenever statements are created.
+"""
+
+from sqlalchemy.sql import select
+
+from .config import load_config, config_to_settings
+from .models import init_db, preferred_value_table, preferred_value_source_table
+from .hot_indexes import resolve_predicates
+from .utility import preferred_value_upsert
+
+
+def select_preferred_sources():
+    source = preferred_value_source_table
+    return select([source.c.predicate_id, source.c.vtype, source.c.keyword])
+
+
+def load_preferred_sources(engine):
+    """Return the (predicate_id, vtype, keyword) combinations that are built."""
+    with engine.connect() as connection:
+        rows = connection.execute(select_preferred_sources())
+        return frozenset(tuple(row) for row in rows)
+
+
+def rebuild_preferred_values(engine, sources):
+    """Compute the preferred values for `sources` from scratch.
+
+    Sources that are no longer wanted are dropped, and all others are rebuilt
+    in the same transaction.
+    """
+    with engine.begin() as connection:
+        connection.execute(preferred_value_table.delete())
+        connection.execute(preferred_value_source_table.delete())
+        for predicate_id, vtype, keyword in sources:
+            print("Building preferred values for {} ...".format(predicate_id))
+            connection.execute(preferred_value_upsert(predicate_id, vtype, keyword))
+            connection.execute(
+                preferred_value_source_table.insert().values(
+                    predicate_id=predicate_id, vtype=vtype, keyword=keyword
+                )
+            )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    engine = init_db(config_to_settings(config, statement_timeout=False))
+    entries = config.get("prefer", {}).get("preferred_values", [])
+    predicate_ids = resolve_predicates(engine, [e["predicate"] for e in entries])
+    sources = set(
+        (predicate_id, e["vtype"], e["keyword"])
+        for predicate_id, e in zip(predicate_ids, entries)
+    )
+    rebuild_preferred_values(engine, sources)
+    print("Preferred values are built for {} predicates".format(len(sources)))
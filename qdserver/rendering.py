@@ -0,0 +1,33 @@
+"""JSON rendering to bytes, with orjson when it is installed."""
+
+import json
+
+try:
+    import orjson
+
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+
+def dumps(value):
+    """Encode `value` as JSON bytes, in a single call of the encoder."""
+    if HAVE_ORJSON:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def json_renderer_factory(info):
+    """Replace Pyramid's "json" renderer, rendering straight to bytes."""
+
+    def render(value, system):
+        request = system.get("request")
+        if request is not None:
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = "application/json"
+        return dumps(value)
+
+    return render
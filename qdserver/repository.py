@@ -1,12 +1,9 @@
-import time
+from collections import defaultdict, namedtuple
 
-from collections import defaultdict
-from itertools import islice
-
-from sqlalchemy import and_, or_
-from sqlalchemy.sql import select
+from sqlalchemy import and_, not_, bindparam, exists, false, func, Integer
+from sqlalchemy.sql import select, union_all
 from sqlalchemy.sql.expression import tuple_ as sqltuple
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
 
 from queryduck.query import (
     JoinEntity,
@@ -16,23 +13,69 @@ from queryduck.query import (
     Prefer,
     Having,
     AfterTuple,
+    QueryEntity,
 )
+from queryduck.constants import Component
 from queryduck.types import Blob, Statement, File, value_types
 
-from .models import statement_table, blob_table, file_table, volume_table
+from .bulk import DEFAULT_BULK_THRESHOLD, copy_to_temp_table, drop_temp_table
+from .cache import PlanCacheEntry
+from .errors import UserError
+from .models import (
+    OBJECT_COLUMNS,
+    statement_table,
+    blob_table,
+    file_table,
+    volume_table,
+    preferred_value_table,
+)
 from .utility import (
     EntitySet,
-    process_db_row,
+    Explain,
+    any_of,
+    batched_select,
+    get_or_create_ids,
+    keyset_after,
+    db_value,
+    preferred_value_upsert,
+    preferred_subject_locks,
+    param_compare,
+    query_shape,
+    notify_changes,
+    change_values,
+    RowDecoder,
+    object_type,
+    shared_statement,
     column_compare,
     final_column_compare,
     prepare_for_db,
 )
 
 
+# Files are looked up by (volume, path) tuples, which need one parameter each
+FILE_BATCH_SIZE = 1000
+
+# Where the parts of a row of PGRepository._select_query are: the position of
+# the files of a Blob result, the RowDecoder of additional statements, and the
+# position of the files of their objects.
+QueryLayout = namedtuple("QueryLayout", ["page_files", "decoder", "statement_files"])
+
+
 class PGRepository:
-    def __init__(self, db):
+    def __init__(
+        self,
+        db,
+        id_cache=None,
+        plan_cache=None,
+        bulk_threshold=DEFAULT_BULK_THRESHOLD,
+        preferred_sources=frozenset(),
+    ):
         """Make relevant services available."""
         self.db = db
+        self.id_cache = id_cache
+        self.plan_cache = plan_cache
+        self.preferred_sources = preferred_sources
+        self.bulk_threshold = bulk_threshold
         self.statement_map = {}
         self.blob_map = {}
 
@@ -67,12 +110,15 @@ class PGRepository:
         """Create a Statement with specified values. None values are changed to be self referential."""
         if handle is None:
             handle = uuid4()
+        notify_changes(self.db)
         insert = statement_table.insert().values(handle=handle)
         (insert_id,) = self.db.execute(insert).inserted_primary_key
         values = {k: (insert_id if v is None else v) for k, v in kwargs.items()}
         where = statement_table.c.id == insert_id
         update = statement_table.update().where(where).values(values)
         self.db.execute(update)
+        if values.get("object_blob_id") is not None:
+            self._update_blob_flags([values["object_blob_id"]], [])
         return insert_id
 
     def create_statements(self, statements):
@@ -82,59 +128,222 @@ class PGRepository:
         self.fill_ids(all_values, allow_create=True)
 
         # convert the supplied rows into values to be upserted
+        # every object column is written, so that re-posting a statement with
+        # an object of another type clears the column of its previous object
+        all_column_names = {"handle", "subject_id", "predicate_id", "object_type"}
+        all_column_names.update(OBJECT_COLUMNS)
         insert_values = []
-        all_column_names = set()
+        upserted = []
         for statement in statements:
             statement = self.unique_add(statement)
             if statement.saved:
                 print("Exists!", statement)
                 continue
+            upserted.append(statement)
             value, column_name = prepare_for_db(statement.triple[2])
-            insert_value = {
-                "handle": statement.handle,
-                "subject_id": statement.triple[0].id,
-                "predicate_id": statement.triple[1].id,
-                column_name: value,
-            }
+            insert_value = dict.fromkeys(OBJECT_COLUMNS)
+            insert_value.update(
+                {
+                    "handle": statement.handle,
+                    "subject_id": statement.triple[0].id,
+                    "predicate_id": statement.triple[1].id,
+                    "object_type": object_type(column_name),
+                    column_name: value,
+                }
+            )
             insert_values.append(insert_value)
-            all_column_names |= insert_value.keys()
-
-        # ensure every row has a value for every column, even if it's None
-        for insert_value in insert_values:
-            for column_name in all_column_names:
-                if column_name not in insert_value:
-                    insert_value[column_name] = None
 
         # actually upsert the rows
+        previous_blob_ids = []
         if insert_values:
+            notify_changes(self.db)
+            previous_blob_ids = self._lock_previous_blob_ids(upserted)
+        if len(insert_values) > self.bulk_threshold:
+            self._bulk_upsert_statements(insert_values, all_column_names)
+        elif insert_values:
             ins = pg_insert(statement_table).values(insert_values)
             on_conflict_set = {
                 cn: getattr(ins.excluded, cn)
                 for cn in all_column_names
                 if cn != "handle"
             }
+            on_conflict_set.update(change_values())
             upd = ins.on_conflict_do_update(
                 index_elements=["handle"], set_=on_conflict_set
             )
             self.db.execute(upd)
 
+        self._update_preferred_values(upserted)
+        self._update_blob_flags(
+            [s.triple[2].id for s in upserted if isinstance(s.triple[2], Blob)],
+            previous_blob_ids,
+        )
         return statements
 
+    def _lock_previous_blob_ids(self, statements):
+        """Lock the existing rows of `statements` and return their object blobs.
+
+        The upsert may replace these, so their has_statements may need clearing.
+        """
+        def make_select(handles):
+            return (
+                select([statement_table.c.object_blob_id])
+                .where(any_of(statement_table.c.handle, handles))
+                .order_by(statement_table.c.id)
+                .with_for_update()
+            )
+
+        rows = batched_select(
+            self.db,
+            make_select,
+            [s.handle for s in statements],
+            label="previous object blobs",
+        )
+        return [blob_id for (blob_id,) in rows if blob_id is not None]
+
+    def _update_blob_flags(self, blob_ids, previous_blob_ids):
+        """Update has_statements of blobs that statements now or used to point to.
+
+        The blobs are locked first, in id order, so that no other transaction
+        can add a statement to a blob in between checking that it has none left
+        and clearing its flag. The check runs after the lock is granted, and
+        therefore sees every statement committed before that.
+        """
+        blob_ids = set(blob_ids)
+        previous_blob_ids = set(previous_blob_ids) - blob_ids
+        if not blob_ids and not previous_blob_ids:
+            return
+        lock = (
+            select([blob_table.c.id])
+            .where(any_of(blob_table.c.id, sorted(blob_ids | previous_blob_ids)))
+            .order_by(blob_table.c.id)
+            .with_for_update()
+        )
+        self.db.execute(lock).fetchall()
+        if blob_ids:
+            mark = (
+                blob_table.update()
+                .where(any_of(blob_table.c.id, sorted(blob_ids)))
+                .where(not_(blob_table.c.has_statements))
+                .values(has_statements=True)
+            )
+            self.db.execute(mark)
+        if previous_blob_ids:
+            referenced = exists().where(
+                statement_table.c.object_blob_id == blob_table.c.id
+            )
+            clear = (
+                blob_table.update()
+                .where(any_of(blob_table.c.id, sorted(previous_blob_ids)))
+                .where(blob_table.c.has_statements)
+                .where(not_(referenced))
+                .values(has_statements=False)
+            )
+            self.db.execute(clear)
+
+    def _update_preferred_values(self, statements):
+        """Recompute the preferred values that these statements can affect.
+
+        That is every subject they belong to now, and every subject they were
+        the preferred value of before.
+        """
+        if not self.preferred_sources or not statements:
+            return
+
+        affected = defaultdict(set)
+        statement_ids = [s.id for s in statements]
+        delete = (
+            preferred_value_table.delete()
+            .where(any_of(preferred_value_table.c.statement_id, statement_ids))
+            .returning(
+                preferred_value_table.c.predicate_id,
+                preferred_value_table.c.vtype,
+                preferred_value_table.c.keyword,
+                preferred_value_table.c.subject_id,
+            )
+        )
+        for predicate_id, vtype, keyword, subject_id in self.db.execute(delete):
+            affected[(predicate_id, vtype, keyword)].add(subject_id)
+
+        for statement in statements:
+            for source in self.preferred_sources:
+                if source[0] == statement.triple[1].id:
+                    affected[source].add(statement.triple[0].id)
+
+        if not affected:
+            return
+        locks = {
+            (source[0], subject_id)
+            for source, subject_ids in affected.items()
+            for subject_id in subject_ids
+        }
+        self.db.execute(preferred_subject_locks(locks))
+        for (predicate_id, vtype, keyword), subject_ids in affected.items():
+            upsert = preferred_value_upsert(
+                predicate_id, vtype, keyword, list(subject_ids)
+            )
+            self.db.execute(upsert)
+
+    def _bulk_upsert_statements(self, insert_values, column_names):
+        """Upsert many rows by COPYing them into a temporary table first."""
+        columns = [c for c in statement_table.c if c.name in column_names]
+        rows = ([v[c.name] for c in columns] for v in insert_values)
+        tmp = copy_to_temp_table(self.db, "tmp_statement", columns, rows)
+
+        ins = pg_insert(statement_table).from_select(
+            [c.name for c in columns], select([tmp.c[c.name] for c in columns])
+        )
+        on_conflict_set = {
+            c.name: getattr(ins.excluded, c.name) for c in columns if c.name != "handle"
+        }
+        on_conflict_set.update(change_values())
+        upd = ins.on_conflict_do_update(index_elements=["handle"], set_=on_conflict_set)
+        self.db.execute(upd)
+        drop_temp_table(self.db, "tmp_statement")
+
     def get_all_statements(self, after=None):
+        s, entities = self.select_all_statements(after)
+        results = self.db.execute(s)
+        quads = self.process_result_quads(results, RowDecoder(s, entities))
+        return quads
+
+    def select_all_statements(self, after=None):
         s, entities = self.select_full_statements(statement_table, blob_files=False)
         s = s.where(statement_table.c.subject_id!=None)
         if after:
             s = s.where(statement_table.c.handle>after.handle)
         s = s.order_by(statement_table.c.handle).limit(10000)
-        results = self.db.execute(s)
-        quads = self.process_result_quads(results, entities)
-        return quads
+        return s, entities
+
+    def iter_all_statements(self, after=None, page_size=1000):
+        """Yield all quads in handle order, fetched through a server-side cursor.
+
+        Only `page_size` rows are held in memory at any time, regardless of
+        how many statements exist.
+        """
+        s, entities = self.select_full_statements(statement_table, blob_files=False)
+        s = s.where(statement_table.c.subject_id != None)
+        if after:
+            s = s.where(statement_table.c.handle > after.handle)
+        s = s.order_by(statement_table.c.handle)
+        decoder = RowDecoder(s, entities)
+        results = self.db.execution_options(
+            stream_results=True, max_row_buffer=page_size
+        ).execute(s)
+        try:
+            while True:
+                rows = results.fetchmany(page_size)
+                if not rows:
+                    break
+                yield from self.process_result_quads(rows, decoder)
+        finally:
+            results.close()
 
     def get_statements_by_handles(self, handles):
         s, entities = self.select_full_statements(statement_table, blob_files=False)
         s = s.where(statement_table.c.handle.in_(handles))
         results = self.db.execute(s)
-        statements = self.process_result_statements(results, entities)
+        statements = self.process_result_statements(results, RowDecoder(s, entities))
         return statements
 
     def get_blobs_by_sums(self, sums):
@@ -194,53 +403,65 @@ class PGRepository:
         return s, entities
 
     @staticmethod
-    def process_result_quads(results, entities):
-        processed = []
-        for row in results:
-            elements = (
-                Statement(handle=row[entities["main"].c.handle]),
-                Statement(handle=row[entities["su"].c.handle]),
-                Statement(handle=row[entities["pr"].c.handle]),
-                process_db_row(row, entities["main"].c, entities)[0],
-            )
-            processed.append(elements)
-        return processed
+    def process_result_quads(results, decoder):
+        return decoder.quads(results)
 
-    def process_result_statements(self, results, entities):
+    def process_result_statements(self, results, decoder):
+        """Turn rows into Statements, shared with all others of this repository."""
         processed = []
         for row in results:
-            statement = Statement(
-                handle=row[entities["main"].c.handle], id_=row[entities["main"].c.id]
-            )
-            if row[entities["su"].c.handle]:
-                statement.triple = (
-                    Statement(handle=row[entities["su"].c.handle]),
-                    Statement(handle=row[entities["pr"].c.handle]),
-                    process_db_row(row, entities["main"].c, entities)[0],
-                )
+            statement = shared_statement(self.statement_map, row[decoder.handle])
+            if statement.id is None:
+                statement.id = row[decoder.id]
+            if row[decoder.subject]:
+                if statement.triple is None:
+                    statement.triple = (
+                        shared_statement(self.statement_map, row[decoder.subject]),
+                        shared_statement(self.statement_map, row[decoder.predicate]),
+                        decoder.value(row, self.statement_map),
+                    )
                 statement.saved = True
-            statement = self.unique_add(statement)
             processed.append(statement)
         return processed
 
     def get_statement_id_map(self, statements):
         handles = [s.handle for s in statements]
-        sel = select([statement_table.c.id, statement_table.c.handle]).where(
-            statement_table.c.handle.in_(handles)
+        rows = batched_select(
+            self.db,
+            lambda chunk: self.select_ids(statement_table, chunk),
+            handles,
+            label="statement ids",
         )
-        result = self.db.execute(sel)
-        id_map = {u: i for i, u in result.fetchall()}
+        id_map = {u: i for i, u in rows}
         return id_map
 
     def get_blob_id_map(self, blobs):
         handles = [b.handle for b in blobs]
-        sel = select([blob_table.c.id, blob_table.c.handle]).where(
-            blob_table.c.handle.in_(handles)
+        rows = batched_select(
+            self.db,
+            lambda chunk: self.select_ids(blob_table, chunk),
+            handles,
+            label="blob ids",
         )
-        result = self.db.execute(sel)
-        id_map = {u: i for i, u in result.fetchall()}
+        id_map = {u: i for i, u in rows}
         return id_map
 
+    @staticmethod
+    def select_ids(table, handles):
+        return select([table.c.id, table.c.handle]).where(
+            any_of(table.c.handle, handles)
+        )
+
+    def get_or_create_statement_id_map(self, statements):
+        handles = [s.handle for s in statements]
+        return get_or_create_ids(
+            self.db, statement_table, handles, label="statement ids"
+        )
+
+    def get_or_create_blob_id_map(self, blobs):
+        handles = [b.handle for b in blobs]
+        return get_or_create_ids(self.db, blob_table, handles, label="blob ids")
+
     def fill_ids(self, values, allow_create=False):
         statements = list(filter(lambda v: type(v) == Statement, values))
         self.fill_statement_ids(statements, allow_create)
@@ -249,51 +470,36 @@ class PGRepository:
         files = list(filter(lambda v: type(v) == File, values))
         self.fill_file_blobs(files)
 
-    def fill_statement_ids(self, statements, allow_create=False):
-        id_map = self.get_statement_id_map(statements)
-        missing = []
-        for s in statements:
-            if s.handle in id_map:
-                s.id = id_map[s.handle]
-            else:
-                missing.append(s)
-
-        if not missing:
-            return
+    def _get_cached_id_map(self, values, kind, get_id_map):
+        """Look up ids in the identity cache, querying only for the remainder."""
+        if self.id_cache is None:
+            return get_id_map(values)
+
+        id_map = getattr(self.id_cache, kind).get_many({v.handle for v in values})
+        uncached = [v for v in values if v.handle not in id_map]
+        if uncached:
+            found = get_id_map(uncached)
+            self.id_cache.stage(self.db, kind, found)
+            id_map.update(found)
+        return id_map
 
+    def fill_statement_ids(self, statements, allow_create=False):
         if allow_create:
-            ins = statement_table.insert().values(
-                [{"handle": s.handle} for s in missing]
-            )
-            self.db.execute(ins)
-            id_map = self.get_statement_id_map(missing)
-            for s in missing:
-                s.id = id_map[s.handle]
+            get_id_map = self.get_or_create_statement_id_map
         else:
-            for s in missing:
-                s.id = -1
+            get_id_map = self.get_statement_id_map
+        id_map = self._get_cached_id_map(statements, "statements", get_id_map)
+        for s in statements:
+            s.id = id_map.get(s.handle, -1)
 
     def fill_blob_ids(self, blobs, allow_create=False):
-        id_map = self.get_blob_id_map(blobs)
-        missing = []
-        for b in blobs:
-            if b.handle in id_map:
-                b.id = id_map[b.handle]
-            else:
-                missing.append(b)
-
-        if not missing:
-            return
-
         if allow_create:
-            ins = blob_table.insert().values([{"handle": b.handle} for b in missing])
-            self.db.execute(ins)
-            id_map = self.get_blob_id_map(missing)
-            for b in missing:
-                b.id = id_map[b.handle]
+            get_id_map = self.get_or_create_blob_id_map
         else:
-            for b in missing:
-                b.id = -1
+            get_id_map = self.get_blob_id_map
+        id_map = self._get_cached_id_map(blobs, "blobs", get_id_map)
+        for b in blobs:
+            b.id = id_map.get(b.handle, -1)
 
     def get_target_table(self, target_name):
         if target_name == "blob":
@@ -312,21 +518,22 @@ class PGRepository:
             volume_table, volume_table.c.id == file_table.c.volume_id, isouter=True
         )
 
-        sel = (
-            select(
-                [
-                    file_table.c.blob_id,
-                    file_table.c.path,
-                    volume_table.c.reference,
-                ]
-            )
-            .select_from(select_from)
-            .where(file_table.c.blob_id.in_(blobs_by_id.keys()))
+        sel = select(
+            [
+                file_table.c.blob_id,
+                file_table.c.path,
+                volume_table.c.reference,
+            ]
+        ).select_from(select_from)
+        rows = batched_select(
+            self.db,
+            lambda chunk: sel.where(any_of(file_table.c.blob_id, chunk)),
+            blobs_by_id.keys(),
+            label="blob files",
         )
-        result = self.db.execute(sel)
 
         files = defaultdict(list)
-        for row in result.fetchall():
+        for row in rows:
             key = blobs_by_id[row[file_table.c.blob_id]]
             f = File(
                 volume=row[volume_table.c.reference],
@@ -336,67 +543,88 @@ class PGRepository:
         return files
 
     def fill_file_blobs(self, files):
+        in_values = [(f.volume, f.path) for f in files]
+        # Tuples can't be passed as a single array, so use smaller IN batches
+        rows = batched_select(
+            self.db,
+            self.select_file_blobs,
+            in_values,
+            size=FILE_BATCH_SIZE,
+            label="file blobs",
+        )
+        return self._set_file_blobs(files, rows)
+
+    @staticmethod
+    def select_file_blobs(in_values):
         select_from = file_table.join(
             volume_table, volume_table.c.id == file_table.c.volume_id, isouter=True
         ).join(blob_table, blob_table.c.id == file_table.c.blob_id, isouter=True)
 
         file_tuple = sqltuple(volume_table.c.reference, file_table.c.path)
-        in_values = [(f.volume, f.path) for f in files]
-
-        sel = (
-            select([
-                blob_table.c.id,
-                blob_table.c.handle,
-                volume_table.c.reference,
-                file_table.c.path,
-            ])
+        return (
+            select(
+                [
+                    blob_table.c.id,
+                    blob_table.c.handle,
+                    volume_table.c.reference,
+                    file_table.c.path,
+                ]
+            )
             .select_from(select_from)
             .where(file_tuple.in_(in_values))
         )
-        res = self.db.execute(sel)
+
+    @staticmethod
+    def _set_file_blobs(files, rows):
         file_blobs = {}
-        for id_, handle, volume, path in res.fetchall():
+        for id_, handle, volume, path in rows:
             file_blobs[(volume, path)] = Blob(handle=handle, id_=id_)
         for f in files:
             f.blob = file_blobs[(f.volume, f.path)]
         return files
 
-    def _verbose_execute(self, db_query, label="untitled"):
-        print(f"------ START DB QUERY {label} ------")
-        try:
-            compiled = db_query.compile(
-                dialect=self.db.dialect, compile_kwargs={"literal_binds": True}
-            )
-            print(compiled)
-        except:
-            compiled = db_query.compile(dialect=self.db.dialect)
-            print(compiled)
-            print(compiled.params)
-        start = time.time()
-        result = self.db.execute(db_query)
-        end = time.time()
-        duration = end - start
-        print(f"------ END DB QUERY {label}, took {duration:.3f} seconds ------")
-        return result
-
-    def _query_to_select(self, query):
-        self.fill_ids(query.seen_values)
+    def _execute(self, db_query, label="untitled", params=None):
+        """Execute a query, labelled for the query instrumentation."""
+        db = self.db.execution_options(query_label=label)
+        if params is None:
+            return db.execute(db_query)
+        return db.execute(db_query, params)
+
+    def _query_to_select(self, query, cursor=None):
+        """Construct the select() for a query, with placeholders for all values.
+
+        The values are collected separately by _query_params, so the select()
+        only depends on the shape of the query. Of the cursor, only the
+        positions of NULL values matter here.
+
+        Results are picked by DISTINCT ON, which must be sorted by handle, so
+        an ordered page can't stop reading at its LIMIT. When every ordering
+        value is the same for all rows of a result, the cursor condition
+        skips the earlier results before they're collected and sorted.
+        Otherwise it can only apply afterwards, and every page sorts the
+        full result set.
+        """
         table = blob_table if query.target == Blob else statement_table
         es = EntitySet({"main": table.alias("main")})
+        es.preferred = self._preferred_entities(query)
 
-        for k, v in query.joins.items():
+        for n, (k, v) in enumerate(query.joins.items()):
             if k == "main":
                 continue
             es.register_entity(k, v)
+            es.predicate_params[k] = f"join_{n}"
 
         wheres = []
-        for f in query.get_elements(Filter):
-            where = es.db_compare(f)
+        for i, f in enumerate(query.get_elements(Filter)):
+            where = es.db_compare(f, f"filter_{i}")
             wheres.append(where)
 
         prefer_by = []
         for p in query.get_elements(Prefer):
             by = es.get_alias(p.by.key)
+            if p.by.key in es.preferred:
+                # There's only one candidate left to choose from
+                continue
             column_name = value_types[p.vtype]["column_name"]
             if p.keyword == "max":
                 prefer_by.append(by.c[column_name].desc())
@@ -404,20 +632,23 @@ class PGRepository:
                 prefer_by.append(by.c[column_name])
 
         order_by = []
+        order_columns = []
         for o in query.get_elements(Order):
             by = es.get_alias(o.by.key)
             column_name = value_types[o.vtype]["column_name"]
-            order_by.append((by.c[column_name].label(None), o.keyword == "desc"))
+            column = by.c[column_name]
+            order_by.append((column.label(None), o.keyword == "desc"))
+            order_columns.append((column, o.keyword == "desc"))
 
         having = []
         extra_columns = []
-        for h in query.get_elements(Having):
+        for i, h in enumerate(query.get_elements(Having)):
             lhs = es.get_alias(h.lhs.key)
             column_label, op_method, db_value = final_column_compare(
                 h.rhs, h.keyword, lhs.c
             )
             extra_columns.append(column_label)
-            having.append((column_label, op_method, db_value))
+            having.append((column_label, op_method, f"having_{i}", type(h.rhs) == list))
 
         inner = select(
             [es.aliases["main"].c.id, es.aliases["main"].c.handle]
@@ -430,53 +661,297 @@ class PGRepository:
             .order_by(es.aliases["main"].c.handle, *prefer_by)
         )
 
+        # Only the handle is compared, so this applies before DISTINCT ON
+        for i, a in enumerate(query.get_elements(AfterTuple)):
+            handle = es.aliases["main"].c.handle
+            inner = inner.where(handle > bindparam(f"after_{i}", type_=handle.type))
+
+        if cursor is not None and len(cursor) != len(order_by) + 1:
+            raise UserError("Cursor does not match the ordering of this query")
+
+        limit = bindparam("limit", type_=Integer)
         if order_by or having:
+            handle = es.aliases["main"].c.handle
+            inner_keyset = order_columns + [(handle, False)]
+            values = None
+            if cursor is not None:
+                values = [
+                    None if v is None else bindparam(f"cursor_{i}", type_=c.type)
+                    for i, ((c, desc), v) in enumerate(zip(inner_keyset, cursor))
+                ]
+            ordered_keys = [o.by.key for o in query.get_elements(Order)]
+            if values is not None and self._single_valued(query, es, ordered_keys):
+                inner = inner.where(keyset_after(inner_keyset, values))
+                values = None
+
             inner = inner.alias("innerquery")
             outer = select([inner]).select_from(inner)
             wheres = []
-            for column_label, op, db_value in having:
+            for column_label, op, key, many in having:
                 column = inner.c[column_label.name]
-                wheres.append(getattr(column, op)(db_value))
+                wheres.append(param_compare(column, op, key, many))
+            keyset = [(inner.c[o.name], desc) for o, desc in order_by]
+            keyset.append((inner.c[handle.name], False))
+            if values is not None:
+                wheres.append(keyset_after(keyset, values))
             if wheres:
                 outer = outer.where(and_(*wheres))
-            if order_by:
-                for o, d in order_by:
-                    outer
-                params = []
-                for o, desc in order_by:
-                    if desc:
-                        params.append(inner.c[o.name].desc())
-                    else:
-                        params.append(inner.c[o.name])
-                outer = outer.order_by(*params)
-            else:
-                outer = outer.order_by(inner.c[es.aliases["main"].c.handle.name])
+            params = [c.desc() if desc else c for c, desc in keyset]
+            outer = outer.order_by(*params).limit(limit)
         else:
-            outer = inner.limit(query.limit + 1)
-
-        for a in query.get_elements(AfterTuple):
-            outer = outer.where(es.aliases["main"].c.handle > a.values[0].handle)
-        return outer
-
-    def get_results(self, query):
-        db_select = self._query_to_select(query)
-        resultset = self._verbose_execute(db_select, "main result")
-        results = [
-            query.target(handle=row[1], id_=row[0])
-            for row in islice(resultset, query.limit)
+            handle = es.aliases["main"].c.handle
+            if cursor is not None:
+                inner = inner.where(handle > bindparam("cursor_0", type_=handle.type))
+            outer = inner.limit(limit)
+        return outer, [desc for o, desc in order_by]
+
+    @staticmethod
+    def _single_valued(query, es, keys):
+        """Check that the entities of `keys` have one row per result at most.
+
+        That holds for the result itself, and for entities that are only
+        joined through preferred entities, which have one Statement each.
+        """
+        for key in keys:
+            entity = query.joins[key]
+            while entity is not None and entity.key not in (None, "main"):
+                if entity.key not in es.preferred:
+                    return False
+                entity = entity.target
+        return True
+
+    def _preferred_entities(self, query):
+        """Find the Prefer clauses that can be read from preferred_value.
+
+        That takes a single predicate with a preferred_value source, on
+        statements about the target entity. Entities that are filtered on, or
+        that other filtered entities are joined through, are left alone,
+        because the filter has to apply before the preference.
+        """
+        if not self.preferred_sources:
+            return {}
+        filtered = set()
+        for f in query.get_elements(Filter):
+            for operand in (f.lhs, f.rhs):
+                if isinstance(operand, QueryEntity):
+                    filtered.add(operand.key)
+        for h in query.get_elements(Having):
+            filtered.add(h.lhs.key)
+        for key in list(filtered):
+            entity = query.joins.get(key)
+            while entity is not None and entity.key not in (None, "main"):
+                filtered.add(entity.key)
+                entity = entity.target
+
+        preferred = {}
+        for p in query.get_elements(Prefer):
+            entity = query.joins[p.by.key]
+            if (
+                p.by.key in filtered
+                or entity.value_component != Component.OBJECT
+                or len(entity.predicates) != 1
+            ):
+                continue
+            source = (entity.predicates[0].id, p.vtype, p.keyword)
+            if source in self.preferred_sources:
+                preferred[p.by.key] = (p.vtype, p.keyword)
+        return preferred
+
+    @staticmethod
+    def _query_params(query, cursor=None):
+        """Collect the values to bind to the select() of _query_to_select."""
+        params = {"limit": query.limit + 1, "shown": query.limit}
+        for n, (k, v) in enumerate(query.joins.items()):
+            if k != "main" and len(v.predicates):
+                params[f"join_{n}"] = [p.id for p in v.predicates]
+        for i, f in enumerate(query.get_elements(Filter)):
+            if not isinstance(f.rhs, QueryEntity):
+                params[f"filter_{i}"] = db_value(f.rhs)
+        for i, h in enumerate(query.get_elements(Having)):
+            params[f"having_{i}"] = db_value(h.rhs)
+        if cursor is not None:
+            for i, v in enumerate(cursor):
+                if v is not None:
+                    params[f"cursor_{i}"] = v
+        for i, a in enumerate(query.get_elements(AfterTuple)):
+            params[f"after_{i}"] = a.values[0].handle
+        return params
+
+    def _compile_query(self, query, cursor, params):
+        """Compile the query for a page of results, or take it from the cache.
+
+        Returns the compiled query and the QueryLayout of its rows. The plan
+        cache keeps the select() and the first parameters it was used with
+        next to the compiled query, so the index advisor can replay the query
+        later.
+        """
+        shape = query_shape(query, cursor, self._preferred_entities(query))
+        if self.plan_cache is not None:
+            entry = self.plan_cache.get(shape)
+            if entry is not None:
+                return entry.compiled, entry.layout
+
+        db_select, layout = self._select_query(query, cursor)
+        compiled = self._compile(db_select)
+        if self.plan_cache is not None:
+            self.plan_cache.set(
+                shape, PlanCacheEntry(compiled, db_select, params, layout)
+            )
+        return compiled, layout
+
+    def _compile(self, db_select):
+        return db_select.compile(dialect=self.db.dialect)
+
+    def _select_query(self, query, cursor):
+        """Construct a select() for a page of results and its statements.
+
+        The page, limited to its extra row, is a CTE that the additional
+        statements read their ids from, leaving out the extra row. Both are
+        returned by a FULL JOIN on false: every row holds either a result or
+        an additional statement, and the columns of the other are NULL.
+        """
+        db_select, ordering = self._query_to_select(query, cursor)
+        if query.target == Blob:
+            db_select = self._with_blob_files(db_select, ordering)
+        page = db_select.cte("results")
+        columns = list(page.c)
+        order_by = self._page_order(columns, ordering)
+        page_files = len(columns) - 2 if query.target == Blob else None
+
+        shown = (
+            select([columns[0]])
+            .order_by(*order_by)
+            .limit(bindparam("shown", type_=Integer))
+            .cte("shown")
+        )
+        s, decoder = self._select_additional_statements(
+            query, select([shown.c[columns[0].name]]), offset=len(columns)
+        )
+        if s is None:
+            layout = QueryLayout(page_files, None, None)
+            return select(columns).order_by(*order_by), layout
+
+        statement_files = len(columns) + len(list(s.inner_columns)) - 2
+        additional = s.apply_labels().alias("additional")
+        db_select = (
+            select(columns + list(additional.c))
+            .select_from(page.join(additional, false(), full=True))
+            .order_by(*order_by)
+        )
+        return db_select, QueryLayout(page_files, decoder, statement_files)
+
+    @staticmethod
+    def _page_order(columns, ordering):
+        """Return the ORDER BY of a page, given its columns and `ordering`."""
+        keyset = [(columns[2 + i], desc) for i, desc in enumerate(ordering)]
+        keyset.append((columns[1], False))
+        return [c.desc() if desc else c for c, desc in keyset]
+
+    def _with_blob_files(self, db_select, ordering):
+        """Add the files of every resulting Blob, for the limited page only."""
+        page = db_select.alias("page")
+        columns = list(page.c)
+        return select(columns + self._blob_file_columns(columns[0])).order_by(
+            *self._page_order(columns, ordering)
+        )
+
+    @staticmethod
+    def _blob_file_columns(blob_id):
+        """Construct correlated sub-queries that collect the files of a blob."""
+        select_from = file_table.join(
+            volume_table, volume_table.c.id == file_table.c.volume_id, isouter=True
+        )
+
+        def aggregate(column):
+            return (
+                select([func.array_agg(aggregate_order_by(column, file_table.c.id))])
+                .select_from(select_from)
+                .where(file_table.c.blob_id == blob_id)
+                .as_scalar()
+            )
+
+        return [
+            aggregate(volume_table.c.reference).label("file_volumes"),
+            aggregate(file_table.c.path).label("file_paths"),
         ]
-        more = resultset.rowcount > query.limit
-        return results, more
 
-    def get_additional_statements(self, query, results):
-        main_ids = [s.id for s in results]
+    @staticmethod
+    def _row_files(row, position):
+        """Return the files collected by _blob_file_columns at `position`."""
+        volumes, paths = row[position], row[position + 1]
+        if not paths:
+            return []
+        return [File(volume=volume, path=path) for volume, path in zip(volumes, paths)]
+
+    def run_query(self, query, cursor=None):
+        """Fetch a page of results, with additional statements and blob files.
+
+        Everything is fetched by a single query, see _select_query.
+        """
+        self.fill_ids(query.seen_values)
+        params = self._query_params(query, cursor)
+        compiled, layout = self._compile_query(query, cursor, params)
+        rows = self._execute(compiled, "main result", params).fetchall()
+        return self._process_query_rows(query, rows, layout)
+
+    def _process_query_rows(self, query, rows, layout):
+        """Split the rows of _select_query into the parts of the response."""
+        page_rows = [row for row in rows if row[0] is not None]
+        values, more, next_cursor, files = self._process_results(
+            query, page_rows, layout.page_files
+        )
+        statements = []
+        if layout.decoder is not None:
+            statement_rows = [row for row in rows if row[layout.decoder.id] is not None]
+            statements, statement_files = self._process_additional_statements(
+                statement_rows, layout.decoder, layout.statement_files
+            )
+            files.update(statement_files)
+        return values, more, next_cursor, statements, files
+
+    def _process_results(self, query, rows, files_position):
+        # The query is limited to one extra row, which only tells us there's more
+        more = len(rows) > query.limit
+        rows = rows[: query.limit]
+        results = [query.target(handle=row[1], id_=row[0]) for row in rows]
+
+        files = {}
         if query.target == Blob:
-            table = blob_table
-            ids = []
+            for blob, row in zip(results, rows):
+                blob_files = self._row_files(row, files_position)
+                if blob_files:
+                    files[blob] = blob_files
+
+        if rows:
+            last = rows[-1]
+            order_count = sum(1 for o in query.get_elements(Order))
+            next_cursor = [last[2 + i] for i in range(order_count)] + [last[1]]
         else:
-            table = statement_table
-            ids = main_ids[:]
+            next_cursor = None
+        return results, more, next_cursor, files
+
+    def estimate_result_count(self, query):
+        """Return the planner's estimate of the total number of results."""
+        self.fill_ids(query.seen_values)
+        explain, params = self._explain_query(query)
+        plan = self._execute(explain, "estimate", params).scalar()
+        return plan[0]["Plan"]["Plan Rows"]
+
+    def _explain_query(self, query):
+        db_select, _ = self._query_to_select(query)
+        return Explain(db_select.limit(None)), self._query_params(query)
+
+    def _select_additional_statements(self, query, ids, offset=0):
+        """Construct the select() of the statements to return with a page.
+
+        Those are the results themselves, if they're statements, and all
+        FetchEntity values of them. `ids` selects the ids of the results, and
+        the columns of the statements start at `offset` in the rows that the
+        returned RowDecoder reads.
+        """
+        table = blob_table if query.target == Blob else statement_table
 
+        fetches = []
         for f in query.get_elements(FetchEntity):
             es = EntitySet({"main": table.alias("main")})
             for k, v in query.joins.items():
@@ -489,15 +964,33 @@ class PGRepository:
             sel = (
                 select([alias.c.id])
                 .select_from(es.fromclause)
-                .where(es.aliases["main"].c.id.in_(main_ids))
+                .where(es.aliases["main"].c.id.in_(ids))
             )
-            res = self._verbose_execute(sel, "additional values")
-            ids += [i[0] for i in res.fetchall()]
+            fetches.append(sel)
+
+        if table is statement_table:
+            fetches.insert(0, ids)
+        if not fetches:
+            return None, None
+        # A single IN, as Postgres can't use the primary key through an OR
+        if len(fetches) == 1:
+            ids = fetches[0]
+        else:
+            ids = union_all(*fetches)
 
         s, entities = self.select_full_statements(statement_table)
-        where = statement_table.c.id.in_(set(ids))
-        s = s.where(where).distinct(statement_table.c.id)
-
-        results = self.db.execute(s)
-        statements = self.process_result_statements(results, entities)
-        return statements
+        s = s.where(statement_table.c.id.in_(ids)).distinct(statement_table.c.id)
+        for column in self._blob_file_columns(statement_table.c.object_blob_id):
+            s = s.column(column)
+        return s, RowDecoder(s, entities, offset)
+
+    def _process_additional_statements(self, rows, decoder, files_position):
+        statements = self.process_result_statements(rows, decoder)
+
+        files = {}
+        for statement, row in zip(statements, rows):
+            if statement.triple and type(statement.triple[2]) == Blob:
+                blob_files = self._row_files(row, files_position)
+                if blob_files:
+                    files[statement.triple[2]] = blob_files
+        return statements, files
@@ -0,0 +1,87 @@
+import json
+import os
+import signal
+import threading
+
+from types import MappingProxyType
+
+from queryduck.constants import DEFAULT_SCHEMA_FILES
+from queryduck.schema import Bindings
+from queryduck.serialization import deserialize
+from queryduck.types import Statement
+
+from .repository import PGRepository
+
+
+DEFAULT_SCHEMA_PATH = "../queryduck/queryduck/schemas"
+
+
+def load_schemas(schema_path=DEFAULT_SCHEMA_PATH):
+    schemas = []
+    for filename in DEFAULT_SCHEMA_FILES:
+        with open(os.path.join(schema_path, filename), "r") as f:
+            schemas.append(json.load(f))
+    return schemas
+
+
+def load_bindings(engine, id_cache=None, schema_path=DEFAULT_SCHEMA_PATH):
+    """Read the schema files and look up the database ids of their bindings.
+
+    Returns a read-only mapping of names to (handle, id) tuples, where the id
+    is None for bindings that are not in the database yet. Nothing is written:
+    missing bindings are created by the first request that saves them.
+    """
+    schemas = load_schemas(schema_path)
+    connection = engine.connect()
+    try:
+        repo = PGRepository(connection, id_cache=id_cache)
+        bindings_content = {}
+        for schema in schemas:
+            for k, v in schema["bindings"].items():
+                bindings_content[k] = repo.unique_add(deserialize(v))
+        repo.fill_ids(bindings_content.values())
+    finally:
+        connection.close()
+    return MappingProxyType(
+        {
+            k: (v.handle, v.id if v.id != -1 else None)
+            for k, v in bindings_content.items()
+        }
+    )
+
+
+def bindings_for(repo, binding_ids):
+    """Return Bindings made of Statements of `repo`, never shared with others."""
+    bindings_content = {}
+    for k, (handle, id_) in binding_ids.items():
+        statement = repo.unique_add(Statement(handle=handle))
+        if statement.id is None:
+            statement.id = id_
+        bindings_content[k] = statement
+    return Bindings(bindings_content)
+
+
+def reload_bindings(registry):
+    """(Re)load the binding ids shared by all requests of this process."""
+    schema_path = registry.settings.get("qdserver.schema_path", DEFAULT_SCHEMA_PATH)
+    registry.binding_ids = load_bindings(
+        registry.engine, registry.id_cache, schema_path
+    )
+    return registry.binding_ids
+
+
+def install_reload_handler(registry):
+    """Reload the binding ids of this process when it receives SIGHUP.
+
+    The reload runs in a thread of its own, not in the signal handler. Under
+    gunicorn, send HUP to the master process instead, which restarts every
+    worker. Signal handlers can only be set from the main thread, so nothing
+    is installed when the application is created in another one.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def reload(signum, frame):
+        threading.Thread(target=reload_bindings, args=(registry,), daemon=True).start()
+
+    signal.signal(signal.SIGHUP, reload)
@@ -3,12 +3,20 @@ import datetime
 import os
 
 from pyramid.view import view_config
-from sqlalchemy.sql import select, and_, not_
-from sqlalchemy.sql.expression import exists
+from sqlalchemy.sql import select, and_, not_, func
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
+from ..bulk import DEFAULT_BULK_THRESHOLD, copy_to_temp_table, drop_temp_table
 from ..controllers import BaseController
-from ..models import statement_table, volume_table, blob_table, file_table
+from ..models import (
+    file_deletion_table,
+    volume_table,
+    blob_table,
+    file_table,
+    volume_digest_table,
+)
+from ..utility import any_of, change_values, get_or_create_ids, notify_changes
+from .digest import file_digest, format_digest, path_bucket, select_bucket_digests
 
 
 class StorageController(BaseController):
@@ -42,56 +50,88 @@ class StorageController(BaseController):
         self.db.execute(delete)
         return {}
 
-    def _get_volume(self, reference):
+    def _get_volume(self, reference, for_update=False):
         s = select([volume_table]).where(volume_table.c.reference == reference)
+        if for_update:
+            # Serializes changes to the same volume, and so to its digests
+            s = s.with_for_update()
         volume = self.db.execute(s).fetchone()
         return volume
 
     @view_config(route_name="list_volume_files", renderer="json")
     def list_volume_files(self):
         volume = self._get_volume(self.request.matchdict["volume_reference"])
+        s, limit = self.select_volume_files(volume["id"], self.request.GET)
+        files = [self.file_row_to_dict(r) for r in self.db.execute(s)]
 
+        return {
+            "results": files,
+            "limit": limit,
+        }
+
+    @classmethod
+    def select_volume_files(cls, volume_id, params):
+        """Construct the select() for a page of files, from request parameters.
+
+        `params` needs to support `getall`, like a WebOb MultiDict.
+        """
         j = file_table.join(blob_table, file_table.c.blob_id == blob_table.c.id)
         s = (
             select([file_table, blob_table.c.handle])
             .select_from(j)
-            .where(file_table.c.volume_id == volume["id"])
+            .where(file_table.c.volume_id == volume_id)
         )
 
-        if "without_statements" in self.request.GET:
-            filter_query = (
-                select([statement_table.c.id])
-                .select_from(statement_table)
-                .where(statement_table.c.object_blob_id == blob_table.c.id)
-            )
-            s = s.where(not_(exists(filter_query)))
+        if "without_statements" in params:
+            s = s.where(not_(blob_table.c.has_statements))
 
-        if "path" in self.request.GET:
-            paths = [
-                base64.urlsafe_b64decode(p) for p in self.request.GET.getall("path")
-            ]
+        if "path" in params:
+            paths = [base64.urlsafe_b64decode(p) for p in params.getall("path")]
             s = s.where(file_table.c.path.in_(paths))
 
-        if "after" in self.request.GET:
-            after = base64.urlsafe_b64decode(self.request.GET["after"])
+        if "bucket" in params:
+            s = s.where(file_table.c.bucket == int(params["bucket"]))
+
+        if "after" in params:
+            after = base64.urlsafe_b64decode(params["after"])
             s = s.where(file_table.c.path > after)
 
         limit = 1000
-        if "limit" in self.request.GET:
-            limit = min(int(self.request.GET["limit"]), self.max_limit)
+        if "limit" in params:
+            limit = min(int(params["limit"]), cls.max_limit)
         s = s.order_by(file_table.c.path).limit(limit)
+        return s, limit
+
+    @view_config(route_name="list_volume_orphans", renderer="json")
+    def list_volume_orphans(self):
+        """List the paths and handles of files whose blob has no statements.
+
+        Pages are ordered by path and continue `after` the last path of the
+        previous page, like list_volume_files.
+        """
+        volume = self._get_volume(self.request.matchdict["volume_reference"])
+        params = self.request.GET
+        j = file_table.join(blob_table, file_table.c.blob_id == blob_table.c.id)
+        s = (
+            select([file_table.c.path, blob_table.c.handle])
+            .select_from(j)
+            .where(file_table.c.volume_id == volume["id"])
+            .where(not_(blob_table.c.has_statements))
+        )
+        if "after" in params:
+            after = base64.urlsafe_b64decode(params["after"])
+            s = s.where(file_table.c.path > after)
 
+        limit = 1000
+        if "limit" in params:
+            limit = min(int(params["limit"]), self.max_limit)
+        s = s.order_by(file_table.c.path).limit(limit)
         files = [
             {
-                "path": os.fsdecode(r[file_table.c.path]),
-                "size": r[file_table.c.size],
-                "mtime": r[file_table.c.mtime].isoformat(),
-                "lastverify": r[file_table.c.lastverify].isoformat(),
-                "handle": base64.urlsafe_b64encode(r[blob_table.c.handle]).decode(
-                    "utf-8"
-                ),
+                "path": os.fsdecode(path),
+                "handle": base64.urlsafe_b64encode(handle).decode("utf-8"),
             }
-            for r in self.db.execute(s)
+            for path, handle in self.db.execute(s)
         ]
 
         return {
@@ -99,36 +139,76 @@ class StorageController(BaseController):
             "limit": limit,
         }
 
-    def _process_file_blobs(self, files):
-        """Determines which required blobs don't exist yet, and construct them."""
-        file_checksums = {f["handle"] for f in files}
-        s = select([blob_table.c.handle]).where(blob_table.c.handle.in_(file_checksums))
-        db_checksums = {r for (r,) in self.db.execute(s)}
-        new_checksums = file_checksums - db_checksums
-        return new_checksums
+    @staticmethod
+    def file_row_to_dict(r):
+        return {
+            "path": os.fsdecode(r[file_table.c.path]),
+            "size": r[file_table.c.size],
+            "mtime": r[file_table.c.mtime].isoformat(),
+            "lastverify": r[file_table.c.lastverify].isoformat(),
+            "handle": base64.urlsafe_b64encode(r[blob_table.c.handle]).decode("utf-8"),
+        }
 
     def _process_files(self, files):
-        file_checksums = {f["handle"] for f in files}
-        s = select([blob_table.c.id, blob_table.c.handle]).where(
-            blob_table.c.handle.in_(file_checksums)
+        """Replace the blob handles of files by ids, creating missing blobs."""
+        blob_ids = get_or_create_ids(
+            self.db, blob_table, [f["handle"] for f in files], label="blob ids"
         )
-        blob_ids = {
-            blob_checksum: blob_id for blob_id, blob_checksum in self.db.execute(s)
-        }
         for f in files:
             f["blob_id"] = blob_ids[f["handle"]]
             del f["handle"]
         return files
 
+    @view_config(route_name="get_volume_digest", renderer="json")
+    def get_volume_digest(self):
+        """Return the digest of a volume, and of 256 of its buckets.
+
+        Without a `prefix`, every entry covers 256 buckets: those with the
+        same first byte. With a `prefix` byte, the entries are the buckets
+        under it, which can then be listed with the `bucket` parameter of
+        list_volume_files. See qdserver.storage.digest for how to compute
+        the digests locally.
+        """
+        volume = self._get_volume(self.request.matchdict["volume_reference"])
+        t = volume_digest_table
+        s = select([func.sum(t.c.digest), func.sum(t.c.count)]).where(
+            t.c.volume_id == volume["id"]
+        )
+        total, count = self.db.execute(s).fetchone()
+
+        if "prefix" in self.request.GET:
+            prefix = int(self.request.GET["prefix"])
+            key = t.c.bucket
+            s = select([key, t.c.digest, t.c.count]).where(key / 256 == prefix)
+        else:
+            key = t.c.bucket / 256
+            s = select([key, func.sum(t.c.digest), func.sum(t.c.count)]).group_by(key)
+        s = s.where(t.c.volume_id == volume["id"])
+        buckets = {
+            str(k): [format_digest(digest), int(n)]
+            for k, digest, n in self.db.execute(s)
+        }
+
+        return {
+            "digest": format_digest(total or 0),
+            "count": int(count or 0),
+            "buckets": buckets,
+        }
+
     @view_config(route_name="mutate_volume_files", renderer="json")
     def mutate_volume_files(self):
-        volume = self._get_volume(self.request.matchdict["volume_reference"])
+        volume = self._get_volume(
+            self.request.matchdict["volume_reference"], for_update=True
+        )
         self._mutate_volume_files(volume, self.request.json_body)
         return {}
 
     def _mutate_volume_files(self, volume, files_info):
-        files = [
-            {
+        files = []
+        for path, rf in files_info.items():
+            if rf is None:
+                continue
+            f = {
                 "volume_id": volume.id,
                 "path": os.fsencode(path),
                 "handle": base64.urlsafe_b64decode(rf["handle"]),
@@ -136,31 +216,64 @@ class StorageController(BaseController):
                 "lastverify": datetime.datetime.fromisoformat(rf["lastverify"]),
                 "size": rf["size"],
             }
-            for path, rf in files_info.items()
-            if rf is not None
-        ]
-
-        # Using multi insert seems orders of magnitude faster on Postgres than
-        # multiparam/executemany inserts.
-        new_checksums = self._process_file_blobs(files)
-        if len(new_checksums):
-            self.db.execute(
-                blob_table.insert().values([{"handle": c} for c in new_checksums])
-            )
+            f["digest"] = file_digest(f["path"], f["handle"], f["size"], f["mtime"])
+            f["bucket"] = path_bucket(f["path"])
+            files.append(f)
 
         delete_paths = [
             os.fsencode(path) for path, rf in files_info.items() if rf is None
         ]
+        if files or delete_paths:
+            notify_changes(self.db)
+
         if len(delete_paths):
-            delete = (
+            # Deleted files are remembered for the change feed
+            deleted = (
                 file_table.delete()
                 .where(file_table.c.volume_id == volume["id"])
-                .where(file_table.c.path.in_(delete_paths))
+                .where(any_of(file_table.c.path, delete_paths))
+                .returning(file_table.c.volume_id, file_table.c.path)
+                .cte("deleted")
             )
-            self.db.execute(delete)
+            ins = file_deletion_table.insert().from_select(
+                ["volume_id", "path"], select([deleted.c.volume_id, deleted.c.path])
+            )
+            self.db.execute(ins)
+
+        if len(files) > self._bulk_threshold():
+            self._bulk_upsert_files(files)
+        elif files:
+            self._upsert_files(files)
 
-        # Upsert files in bulk
+        buckets = [f["bucket"] for f in files] + [path_bucket(p) for p in delete_paths]
+        self._update_volume_digests(volume["id"], buckets)
+
+    def _update_volume_digests(self, volume_id, buckets):
+        """Recompute the digests of the buckets in which files have changed."""
+        buckets = sorted(set(buckets))
+        if not buckets:
+            return
+        delete = (
+            volume_digest_table.delete()
+            .where(volume_digest_table.c.volume_id == volume_id)
+            .where(any_of(volume_digest_table.c.bucket, buckets))
+        )
+        self.db.execute(delete)
+        ins = volume_digest_table.insert().from_select(
+            ["volume_id", "bucket", "digest", "count"],
+            select_bucket_digests(volume_id, buckets),
+        )
+        self.db.execute(ins)
+
+    def _bulk_threshold(self):
+        settings = self.request.registry.settings
+        return int(settings.get("qdserver.bulk_threshold", DEFAULT_BULK_THRESHOLD))
+
+    def _upsert_files(self, files):
         files = self._process_files(files)
+
+        # Using multi insert seems orders of magnitude faster on Postgres than
+        # multiparam/executemany inserts.
         ins = pg_insert(file_table).values(files)
         upd = ins.on_conflict_do_update(
             index_elements=["volume_id", "path"],
@@ -169,6 +282,70 @@ class StorageController(BaseController):
                 "size": ins.excluded.size,
                 "mtime": ins.excluded.mtime,
                 "lastverify": ins.excluded.lastverify,
+                "digest": ins.excluded.digest,
+                "bucket": ins.excluded.bucket,
+                **change_values(),
+            },
+        )
+        self.db.execute(upd)
+
+    def _bulk_upsert_files(self, files):
+        """Upsert files and their blobs with COPY and set-based statements."""
+        columns = [
+            file_table.c.volume_id,
+            file_table.c.path,
+            blob_table.c.handle,
+            file_table.c.size,
+            file_table.c.mtime,
+            file_table.c.lastverify,
+            file_table.c.digest,
+            file_table.c.bucket,
+        ]
+        rows = ([f[c.name] for c in columns] for f in files)
+        tmp = copy_to_temp_table(self.db, "tmp_file", columns, rows)
+
+        ins = pg_insert(blob_table).from_select(
+            ["handle"], select([tmp.c.handle]).distinct()
+        )
+        self.db.execute(ins.on_conflict_do_nothing(index_elements=["handle"]))
+
+        j = tmp.join(blob_table, blob_table.c.handle == tmp.c.handle)
+        sel = select(
+            [
+                tmp.c.volume_id,
+                tmp.c.path,
+                blob_table.c.id,
+                tmp.c.size,
+                tmp.c.mtime,
+                tmp.c.lastverify,
+                tmp.c.digest,
+                tmp.c.bucket,
+            ]
+        ).select_from(j)
+        ins = pg_insert(file_table).from_select(
+            [
+                "volume_id",
+                "path",
+                "blob_id",
+                "size",
+                "mtime",
+                "lastverify",
+                "digest",
+                "bucket",
+            ],
+            sel,
+        )
+        upd = ins.on_conflict_do_update(
+            index_elements=["volume_id", "path"],
+            set_={
+                "blob_id": ins.excluded.blob_id,
+                "size": ins.excluded.size,
+                "mtime": ins.excluded.mtime,
+                "lastverify": ins.excluded.lastverify,
+                "digest": ins.excluded.digest,
+                "bucket": ins.excluded.bucket,
+                **change_values(),
             },
         )
         self.db.execute(upd)
+        drop_temp_table(self.db, "tmp_file")
@@ -0,0 +1,89 @@
+"""Digests of volume files, for comparing volumes without listing them.
+
+Every file has a 64 bit digest of its path, blob handle, size and mtime, and
+belongs to one of 65536 buckets, by the hash of its path. Bucket digests are
+the sum of their file digests modulo 2**64, so they can be recomputed from
+the changed buckets only. Clients compute the same values for their local
+files and only list the buckets that differ.
+
+The Python functions here and the SQL expressions that the migration uses
+for existing files must always agree.
+"""
+
+import datetime
+import hashlib
+
+from sqlalchemy import BigInteger, String, cast, extract, func, literal
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.sql import select
+
+from ..models import file_table
+from ..utility import any_of
+
+
+BUCKET_COUNT = 65536
+
+_epoch = datetime.datetime(1970, 1, 1)
+_microsecond = datetime.timedelta(microseconds=1)
+
+
+def path_bucket(path):
+    """Return the bucket of a path: the first two bytes of its SHA-256."""
+    return int.from_bytes(hashlib.sha256(path).digest()[:2], "big")
+
+
+def file_digest(path, handle, size, mtime):
+    """Return the signed 64 bit digest of a file.
+
+    That is the start of the SHA-256 of "<path hex>:<handle hex>:<size>:<mtime
+    in microseconds since the epoch>", with empty fields for missing values.
+    """
+    fields = [
+        path.hex(),
+        handle.hex(),
+        "" if size is None else str(size),
+        "" if mtime is None else str((mtime - _epoch) // _microsecond),
+    ]
+    digest = hashlib.sha256(":".join(fields).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def format_digest(total):
+    """Format the sum of file digests as the hex string clients compare."""
+    return "{:016x}".format(int(total) % 2 ** 64)
+
+
+def sql_path_bucket(path):
+    h = func.sha256(path)
+    return func.get_byte(h, 0) * 256 + func.get_byte(h, 1)
+
+
+def sql_file_digest(path, handle, size, mtime):
+    mtime_us = cast(func.round(extract("epoch", mtime) * 1000000), BigInteger)
+    text = func.concat_ws(
+        ":",
+        func.encode(path, "hex"),
+        func.encode(handle, "hex"),
+        func.coalesce(cast(size, String), ""),
+        func.coalesce(cast(mtime_us, String), ""),
+    )
+    hex_digest = func.encode(func.sha256(func.convert_to(text, "UTF8")), "hex")
+    bits = cast(literal("x") + func.substr(hex_digest, 1, 16), BIT(64))
+    return cast(bits, BigInteger)
+
+
+def select_bucket_digests(volume_id=None, buckets=None):
+    """Construct a select() of bucket digests computed from the files."""
+    s = select(
+        [
+            file_table.c.volume_id,
+            file_table.c.bucket,
+            func.sum(file_table.c.digest),
+            func.count(),
+        ]
+    ).group_by(file_table.c.volume_id, file_table.c.bucket)
+    if volume_id is not None:
+        s = s.where(file_table.c.volume_id == volume_id)
+    if buckets is not None:
+        s = s.where(any_of(file_table.c.bucket, buckets))
+    return s
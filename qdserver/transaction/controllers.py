@@ -1,4 +1,3 @@
-import json
 import uuid
 
 from datetime import datetime as dt
@@ -6,13 +5,12 @@ from datetime import datetime as dt
 from pyramid.view import view_config
 from sqlalchemy.sql import select
 
-from queryduck.constants import DEFAULT_SCHEMA_FILES
 from queryduck.serialization import serialize, deserialize
 from queryduck.types import Statement
-from queryduck.schema import Bindings
 
 from ..controllers import BaseController, StatementController
 from ..models import statement_table
+from ..schema import bindings_for
 
 
 class TransactionController(BaseController):
@@ -25,25 +23,9 @@ class TransactionController(BaseController):
         self.t = statement_table
         self.sc = StatementController(self.request)
         self.repo = self.sc.repo
-        self._bindings = None
-
-    def _bindings_from_schemas(self, schemas):
-        bindings_content = {}
-        for schema in schemas:
-            for k, v in schema["bindings"].items():
-                bindings_content[k] = self.sc.unique_deserialize(v)
-        bindings = Bindings(bindings_content)
-        return bindings
 
     def get_bindings(self):
-        if self._bindings is None:
-            schemas = []
-            for filename in DEFAULT_SCHEMA_FILES:
-                filepath = "../queryduck/queryduck/schemas/{}".format(filename)
-                with open(filepath, "r") as f:
-                    schemas.append(json.load(f))
-            self._bindings = self._bindings_from_schemas(schemas)
-        return self._bindings
+        return bindings_for(self.repo, self.request.registry.binding_ids)
 
     @view_config(route_name="submit_transaction", renderer="json", permission="create")
     def submit_transaction(self):
@@ -1,12 +1,46 @@
-from sqlalchemy import and_
+import base64
+import datetime
+import decimal
+import json
+import uuid
 
-from .models import statement_table
-from .errors import UserError, TodoError
+from sqlalchemy import (
+    and_,
+    or_,
+    all_,
+    any_,
+    bindparam,
+    case,
+    cast,
+    func,
+    literal,
+    Integer,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .models import (
+    OBJECT_COLUMNS,
+    change_seq,
+    preferred_value_table,
+    statement_table,
+)
+from .errors import QDValueError, UserError, TodoError
 
 from queryduck.constants import Component
 from queryduck.serialization import get_native_vtype
 from queryduck.types import Statement, Blob, value_types, value_comparison_methods
-from queryduck.query import QueryEntity
+from queryduck.query import (
+    QueryEntity,
+    Filter,
+    FetchEntity,
+    Prefer,
+    Order,
+    Having,
+    AfterTuple,
+)
 
 
 class EntitySet:
@@ -14,6 +48,10 @@ class EntitySet:
         self.aliases = aliases
         self.entities = {"main": self.aliases["main"]}
         self.fromclause = aliases["main"]
+        # Entities whose predicate ids are bound later, by parameter name
+        self.predicate_params = {}
+        # Entities that are read from preferred_value, as (vtype, keyword)
+        self.preferred = {}
 
     def register_entity(self, key, entity):
         self.entities[key] = entity
@@ -53,12 +91,35 @@ class EntitySet:
         elif target.value_component == Component.SUBJECT:
             rhs = target_alias.c.subject_id
 
+        if key in self.preferred:
+            # Join only the preferred Statement, instead of all candidates
+            vtype, keyword = self.preferred[key]
+            preferred = preferred_value_table.alias(f"{key}_preferred")
+            where = and_(
+                preferred.c.subject_id == rhs,
+                self._predicate_compare(key, entity, preferred.c.predicate_id),
+                preferred.c.vtype == vtype,
+                preferred.c.keyword == keyword,
+            )
+            self.fromclause = self.fromclause.join(
+                preferred, where, isouter=True
+            ).join(alias, alias.c.id == preferred.c.statement_id, isouter=True)
+            return
+
         where = lhs == rhs
         if len(entity.predicates):
-            predicate_ids = [p.id for p in entity.predicates]
-            where = and_(where, alias.c.predicate_id.in_(predicate_ids))
+            predicate_compare = self._predicate_compare(
+                key, entity, alias.c.predicate_id
+            )
+            where = and_(where, predicate_compare)
         self.fromclause = self.fromclause.join(alias, where, isouter=True)
 
+    def _predicate_compare(self, key, entity, column):
+        if key in self.predicate_params:
+            predicates = array_placeholder(self.predicate_params[key], Integer)
+            return column == any_(predicates)
+        return column.in_([p.id for p in entity.predicates])
+
     def get_alias_column(self, alias, component, vtype):
         if component == Component.SELF:
             if not vtype in ("s", "none"):
@@ -73,7 +134,12 @@ class EntitySet:
             column = alias.c[vtype_info["column_name"]]
         return column
 
-    def db_compare(self, f):
+    def db_compare(self, f, param_key=None):
+        """Construct the comparison for Filter `f`.
+
+        If `param_key` is given, a value on the right hand side is left to be
+        bound later under that name.
+        """
         lhs = f.lhs
         op = f.keyword
         rhs = f.rhs
@@ -96,48 +162,187 @@ class EntitySet:
             rhs_operand = self.get_alias_column(rhs_alias, rhs.value_component, "s")
         elif lhs_alias is not None:
             lhs_operand = self.get_alias_column(lhs_alias, lhs.value_component, rhs_type)
-            if rhs_type == "file":
-                if type(rhs) == list:
-                    rhs_operand = [f.blob.id for f in rhs]
-                else:
-                    rhs_operand = rhs.blob.id
-            elif rhs_type in ("s", "blob"):
-                if type(rhs) == list:
-                    rhs_operand = [e.id for e in rhs]
-                else:
-                    rhs_operand = rhs.id
-            else:
-                rhs_operand = rhs
+            rhs_operand = db_value(rhs) if param_key is None else None
         else:
             raise TodoError()
 
         op_method = value_comparison_methods[op]
-        return getattr(lhs_operand, op_method)(rhs_operand)
+        if rhs_operand is None:
+            compare = param_compare(
+                lhs_operand, op_method, param_key, many=type(rhs) == list
+            )
+        else:
+            compare = getattr(lhs_operand, op_method)(rhs_operand)
 
+        if lhs.value_component == Component.OBJECT:
+            # Lets Postgres use the (predicate_id, object_type) index
+            type_compare = lhs_alias.c.object_type == object_type(lhs_operand.name)
+            compare = and_(type_compare, compare)
+        return compare
 
-def process_db_row(db_row, db_columns, db_entities):
-    for try_vtype, options in value_types.items():
-        if not "column_name" in options or not options["column_name"] in db_columns:
-            continue
-        column = db_columns[options["column_name"]]
-        db_value = db_row[column]
-        if db_value is None or try_vtype == "none":
-            continue
-        vtype = try_vtype
-        break
-    else:
-        raise QDValueError("Cannot process DB row {}".format(db_row))
-
-    if vtype == "s":
-        handle = db_row[db_entities["s"].c.handle]
-        v = Statement(handle=handle, id_=db_value)
-    elif vtype == "blob":
-        handle = db_row[db_entities["blob"].c.handle]
-        v = Blob(handle=handle, id_=db_value)
-    else:
-        v = db_value
 
-    return v, vtype
+def param_compare(column, op_method, key, many=False):
+    """Compare `column` to a value that is bound later, by name.
+
+    A list of values is bound as a single array, instead of an expanding IN,
+    so the SQL is the same for any number of values.
+    """
+    if not many:
+        return getattr(column, op_method)(bindparam(key, type_=column.type))
+    values = array_placeholder(key, column.type)
+    if op_method == "in_":
+        return column == any_(values)
+    if op_method == "notin_":
+        return column != all_(values)
+    raise TodoError("Cannot use {} with a list of values".format(op_method))
+
+
+def db_value(value):
+    """Convert a query value, or list of values, to what the database stores."""
+    vtype = get_native_vtype(value[0] if type(value) == list else value)
+
+    def convert(v):
+        if vtype == "file":
+            return v.blob.id
+        elif vtype in ("s", "blob"):
+            return v.id
+        return v
+
+    if type(value) == list:
+        return [convert(v) for v in value]
+    return convert(value)
+
+
+def _operand_shape(operand):
+    if isinstance(operand, QueryEntity):
+        return ("entity", operand.key, operand.value_component)
+    first = operand[0] if type(operand) == list else operand
+    return ("value", get_native_vtype(first), type(operand) == list)
+
+
+def query_shape(query, cursor=None, preferred=()):
+    """Return a hashable key for everything that determines the SQL of `query`.
+
+    Values that are bound as parameters are left out, so queries that only
+    differ in those values share the same key. `preferred` are the keys of
+    entities that are read from preferred_value.
+    """
+    joins = tuple(
+        (
+            k,
+            v.target.key,
+            v.value_component,
+            v.value_type,
+            v.meta,
+            bool(len(v.predicates)),
+        )
+        for k, v in query.joins.items()
+        if k != "main"
+    )
+    filters = tuple(
+        (f.keyword, _operand_shape(f.lhs), _operand_shape(f.rhs))
+        for f in query.get_elements(Filter)
+    )
+    prefers = tuple((p.by.key, p.vtype, p.keyword) for p in query.get_elements(Prefer))
+    orders = tuple((o.by.key, o.vtype, o.keyword) for o in query.get_elements(Order))
+    havings = tuple(
+        (h.lhs.key, h.keyword, _operand_shape(h.rhs))
+        for h in query.get_elements(Having)
+    )
+    afters = sum(1 for a in query.get_elements(AfterTuple))
+    fetches = tuple(f.operand.key for f in query.get_elements(FetchEntity))
+    cursor_nulls = None if cursor is None else tuple(v is None for v in cursor)
+    return (
+        query.target,
+        joins,
+        filters,
+        prefers,
+        orders,
+        havings,
+        afters,
+        fetches,
+        cursor_nulls,
+        tuple(sorted(preferred)),
+    )
+
+
+# Value types by the object column they are stored in. If several value types
+# share a column, the first one decodes it, as process_db_row used to, so they
+# are added in reverse.
+OBJECT_VTYPES = {
+    options["column_name"]: vtype
+    for vtype, options in reversed(list(value_types.items()))
+    if vtype != "none" and "column_name" in options
+}
+
+
+def object_type_case(columns):
+    """Construct the object_type of existing rows from their object columns."""
+    return case(
+        [(columns[name] != None, i) for i, name in enumerate(OBJECT_COLUMNS)]
+    )
+
+
+def shared_statement(statements, handle):
+    """Return the Statement for `handle` from `statements`, adding it if needed."""
+    statement = statements.get(handle)
+    if statement is None:
+        statement = statements[handle] = Statement(handle=handle)
+    return statement
+
+
+class RowDecoder:
+    """Decode the rows of a select() made by select_full_statements.
+
+    Column positions are resolved once per select(), and the column holding
+    the object is read from object_type instead of being searched for.
+    """
+
+    def __init__(self, db_select, entities, offset=0):
+        # The columns of `db_select` may start at `offset` in a wider row
+        positions = {c: offset + i for i, c in enumerate(db_select.inner_columns)}
+        main = entities["main"].c
+        self.id = positions[main.id]
+        self.handle = positions[main.handle]
+        self.subject = positions[entities["su"].c.handle]
+        self.predicate = positions[entities["pr"].c.handle]
+        self.object_type = positions[main.object_type]
+        handles = {
+            "s": positions[entities["s"].c.handle],
+            "blob": positions[entities["blob"].c.handle],
+        }
+        self.objects = []
+        for name in OBJECT_COLUMNS:
+            vtype = OBJECT_VTYPES.get(name)
+            self.objects.append((vtype, positions[main[name]], handles.get(vtype)))
+
+    def value(self, row, statements):
+        """Return the object of a row, sharing Statements through `statements`."""
+        tag = row[self.object_type]
+        if tag is None:
+            raise QDValueError("Cannot process DB row {}".format(row))
+        vtype, position, handle_position = self.objects[tag]
+        if vtype == "s":
+            v = shared_statement(statements, row[handle_position])
+            if v.id is None:
+                v.id = row[position]
+        elif vtype == "blob":
+            v = Blob(handle=row[handle_position], id_=row[position])
+        else:
+            v = row[position]
+        return v
+
+    def quads(self, rows):
+        statements = {}
+        return [
+            (
+                shared_statement(statements, row[self.handle]),
+                shared_statement(statements, row[self.subject]),
+                shared_statement(statements, row[self.predicate]),
+                self.value(row, statements),
+            )
+            for row in rows
+        ]
 
 
 def prepare_for_db(native_value):
@@ -149,6 +354,11 @@ def prepare_for_db(native_value):
     return value, value_types[vtype]["column_name"]
 
 
+def object_type(column_name):
+    """Return the object_type of objects stored in `column_name`."""
+    return OBJECT_COLUMNS.index(column_name)
+
+
 def column_compare(value, op, columns):
     vtype = get_native_vtype(value[0] if type(value) == list else value)
     column = columns[value_types[vtype]["column_name"]]
@@ -169,3 +379,233 @@ def final_column_compare(value, op, columns):
     else:
         db_value = value.id if vtype in ("s", "blob") else value
     return column.label(None), op_method, db_value
+
+
+# Maximum number of keys sent to Postgres in a single lookup query
+LOOKUP_BATCH_SIZE = 5000
+
+
+def chunked(values, size=LOOKUP_BATCH_SIZE):
+    """Split values into lists of at most `size` unique values."""
+    values = list(dict.fromkeys(values))
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def any_of(column, values):
+    """Compare `column` to a list of values passed as one array parameter.
+
+    Unlike IN, this compiles to the same SQL with a single bind parameter
+    no matter how many values there are.
+    """
+    return column == any_(array_param(values, column.type))
+
+
+def array_placeholder(key, item_type):
+    """Like array_param, but for an array that is bound later, by name."""
+    array_type = ARRAY(item_type)
+    return cast(bindparam(key, type_=array_type), array_type)
+
+
+def array_param(values, item_type):
+    """Pass a list of values as a single, typed array bind parameter."""
+    array_type = ARRAY(item_type)
+    return cast(bindparam(None, list(values), type_=array_type), array_type)
+
+
+def batched_select(db, make_select, keys, size=LOOKUP_BATCH_SIZE, label=None):
+    """Yield the rows of `make_select(chunk)` for every chunk of `keys`."""
+    if label is not None:
+        db = db.execution_options(query_label=label)
+    for chunk in chunked(keys, size):
+        yield from db.execute(make_select(chunk))
+
+
+def get_or_create_ids(db, table, handles, size=LOOKUP_BATCH_SIZE, label=None):
+    """Return a handle to id map, inserting rows for handles that don't exist.
+
+    Every batch is resolved with a single statement: the INSERT returns the
+    rows it created, and the SELECT, which sees the snapshot from before the
+    INSERT, returns the rows that already existed.
+    """
+    if label is not None:
+        db = db.execution_options(query_label=label)
+
+    id_map = {}
+    for chunk in chunked(handles, size):
+        handle_array = array_param(chunk, table.c.handle.type)
+        inserted = (
+            pg_insert(table)
+            .from_select(["handle"], select([func.unnest(handle_array)]))
+            .on_conflict_do_nothing(index_elements=["handle"])
+            .returning(table.c.id, table.c.handle)
+            .cte("inserted")
+        )
+        sel = select([inserted.c.id, inserted.c.handle]).union_all(
+            select([table.c.id, table.c.handle]).where(
+                table.c.handle == any_(handle_array)
+            )
+        )
+        id_map.update({h: i for i, h in db.execute(sel)})
+
+    # Rows committed by a concurrent transaction while we were inserting are
+    # neither inserted nor visible in our snapshot, so look those up again.
+    missing = [h for h in dict.fromkeys(handles) if h not in id_map]
+    if missing:
+        rows = batched_select(
+            db,
+            lambda chunk: select([table.c.id, table.c.handle]).where(
+                any_of(table.c.handle, chunk)
+            ),
+            missing,
+            size,
+        )
+        id_map.update({h: i for i, h in rows})
+    return id_map
+
+
+def preferred_value_upsert(predicate_id, vtype, keyword, subject_ids=None):
+    """Construct an upsert that recomputes preferred values for a predicate.
+
+    Only the given subjects are recomputed, or all subjects if `subject_ids`
+    is None.
+    """
+    column = statement_table.c[value_types[vtype]["column_name"]]
+    order = column.desc() if keyword == "max" else column
+    sel = (
+        select(
+            [
+                statement_table.c.predicate_id,
+                literal(vtype),
+                literal(keyword),
+                statement_table.c.subject_id,
+                statement_table.c.id,
+            ]
+        )
+        .where(statement_table.c.predicate_id == predicate_id)
+        .where(statement_table.c.object_type == object_type(column.name))
+        .distinct(statement_table.c.subject_id)
+        .order_by(statement_table.c.subject_id, order, statement_table.c.handle)
+    )
+    if subject_ids is not None:
+        sel = sel.where(any_of(statement_table.c.subject_id, subject_ids))
+
+    ins = pg_insert(preferred_value_table).from_select(
+        ["predicate_id", "vtype", "keyword", "subject_id", "statement_id"], sel
+    )
+    return ins.on_conflict_do_update(
+        index_elements=["predicate_id", "vtype", "keyword", "subject_id"],
+        set_={"statement_id": ins.excluded.statement_id},
+    )
+
+
+def preferred_subject_locks(keys):
+    """Construct a query that locks (predicate id, subject id) pairs.
+
+    The advisory locks are taken in order and held until the end of the
+    transaction. Writers that recompute the preferred values of the same
+    subjects so run one after the other, each seeing what the previous one
+    committed.
+    """
+    keys = list(keys)
+    query = text(
+        "SELECT pg_advisory_xact_lock(k.predicate_id, k.subject_id) FROM "
+        "(SELECT * FROM unnest(:predicate_ids, :subject_ids) "
+        "AS k(predicate_id, subject_id) "
+        "ORDER BY predicate_id, subject_id) AS k"
+    )
+    return query.bindparams(
+        bindparam("predicate_ids", [k[0] for k in keys], type_=ARRAY(Integer)),
+        bindparam("subject_ids", [k[1] for k in keys], type_=ARRAY(Integer)),
+    )
+
+
+# Notification channel of the change feed, see qdserver.changes
+CHANGE_CHANNEL = "qd_changes"
+
+
+def notify_changes(db):
+    """Wake up change feed listeners once the transaction on `db` commits."""
+    db.execute("NOTIFY {}".format(CHANGE_CHANNEL))
+
+
+def change_values():
+    """Return the values that place an updated row in the change feed."""
+    return {"change_xid": func.txid_current(), "change_seq": change_seq.next_value()}
+
+
+def keyset_after(keyset, values):
+    """Match rows that sort after `values` in the ordering given by `keyset`.
+
+    `keyset` is a list of (column, descending) tuples that fully determines
+    the ordering. NULLs sort as Postgres does by default: last when
+    ascending and first when descending.
+    """
+    clauses = []
+    equal = []
+    for (column, desc), value in zip(keyset, values):
+        if value is None:
+            # NULLs come first when descending, and last when ascending
+            after = (column != None) if desc else None
+        elif desc:
+            after = column < value
+        else:
+            after = or_(column > value, column == None)
+        if after is not None:
+            clauses.append(and_(*equal, after))
+        equal.append(column == None if value is None else column == value)
+    return or_(*clauses)
+
+
+_cursor_types = [
+    ("b", bool, lambda v: v, lambda v: v),
+    ("i", int, lambda v: v, lambda v: v),
+    ("d", decimal.Decimal, str, decimal.Decimal),
+    ("s", str, lambda v: v, lambda v: v),
+    (
+        "t",
+        datetime.datetime,
+        datetime.datetime.isoformat,
+        datetime.datetime.fromisoformat,
+    ),
+    ("x", bytes, bytes.hex, bytes.fromhex),
+    ("u", uuid.UUID, str, uuid.UUID),
+]
+
+
+def encode_cursor(values):
+    """Encode database values into an opaque continuation token."""
+    encoded = []
+    for value in values:
+        if value is None:
+            encoded.append(None)
+            continue
+        for tag, type_, encode, decode in _cursor_types:
+            if isinstance(value, type_):
+                encoded.append([tag, encode(value)])
+                break
+        else:
+            raise TodoError("Cannot use {} in a cursor".format(type(value)))
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode("utf-8")).decode()
+
+
+def decode_cursor(token):
+    """Decode a token created by encode_cursor back into database values."""
+    decoders = {tag: decode for tag, type_, encode, decode in _cursor_types}
+    try:
+        encoded = json.loads(base64.urlsafe_b64decode(token))
+        return [None if v is None else decoders[v[0]](v[1]) for v in encoded]
+    except (ValueError, KeyError, TypeError, IndexError, ArithmeticError):
+        raise UserError("Invalid cursor: {}".format(token))
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN a query, returning its plan as a JSON document."""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
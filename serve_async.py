@@ -0,0 +1,9 @@
+import uvicorn
+
+from qdserver.aio import make_app
+from qdserver.config import load_config, config_to_settings
+
+config = load_config()
+app = make_app(config_to_settings(config))
+
+uvicorn.run(app, host=config["http"]["host"], port=config["http"]["port"])
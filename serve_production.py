@@ -0,0 +1,52 @@
+"""Serve the application with multiple worker processes and threads.
+
+Worker processes are managed by gunicorn: send HUP to the master process to
+gracefully reload all workers, and TERM to shut down gracefully.
+"""
+
+from gunicorn.app.base import BaseApplication
+
+from qdserver.config import load_config, config_to_settings
+
+
+class QueryDuckApplication(BaseApplication):
+    def __init__(self, settings, options):
+        self.settings = settings
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Called in every worker after forking, so each worker process gets
+        # its own engine and connection pool.
+        from qdserver import main
+
+        return main(self.settings)
+
+
+config = load_config()
+http = config["http"]
+threads = http.get("threads", 4)
+
+settings = config_to_settings(config)
+# Every thread of a worker may need a connection at the same time, unless the
+# pool size was configured explicitly
+settings.setdefault("sqlalchemy.pool_size", threads)
+
+options = {
+    "bind": "{}:{}".format(http["host"], http["port"]),
+    "workers": http.get("workers", 2),
+    "threads": threads,
+    "worker_class": "gthread",
+    # Only restarts workers that stopped responding to the master; slow
+    # requests are limited by the statement_timeout of the database
+    "timeout": http.get("timeout", 60),
+    "graceful_timeout": http.get("graceful_timeout", 30),
+    "keepalive": http.get("keepalive", 5),
+}
+
+print("Serving on {} with {} workers ...".format(options["bind"], options["workers"]))
+QueryDuckApplication(settings, options).run()
@@ -0,0 +1,35 @@
+"""Fixtures for tests that need a PostgreSQL database.
+
+Set QDSERVER_TEST_DATABASE_URL to an empty database to run them. Every test
+creates the schema in a transaction of its own and rolls it back afterwards.
+"""
+
+import os
+
+import pytest
+
+from sqlalchemy import create_engine
+
+from qdserver.models import meta
+
+
+@pytest.fixture(scope="session")
+def engine():
+    url = os.environ.get("QDSERVER_TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("QDSERVER_TEST_DATABASE_URL is not set")
+    engine = create_engine(url)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    connection = engine.connect()
+    transaction = connection.begin()
+    meta.create_all(connection)
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
@@ -0,0 +1,73 @@
+"""Stand-ins for queryduck queries, with only what the repository reads."""
+
+import uuid
+
+from queryduck.constants import Component
+from queryduck.query import (
+    AfterTuple,
+    FetchEntity,
+    Filter,
+    Order,
+    Prefer,
+    QueryEntity,
+)
+from queryduck.types import Statement, value_comparison_methods
+
+
+EQ = next(k for k, v in value_comparison_methods.items() if v == "__eq__")
+
+
+class Entity(QueryEntity):
+    """A query entity with only what the repository reads of it."""
+
+    def __init__(self, key, target=None, predicates=()):
+        self.key = key
+        self.target = target
+        self.value_component = Component.OBJECT if target else Component.SELF
+        self.value_type = Statement
+        self.meta = False
+        self.predicates = list(predicates)
+
+
+class EntityFilter(Filter):
+    def __init__(self, lhs, keyword, rhs):
+        self.lhs, self.keyword, self.rhs = lhs, keyword, rhs
+
+
+class EntityPrefer(Prefer):
+    def __init__(self, by, vtype, keyword):
+        self.by, self.vtype, self.keyword = by, vtype, keyword
+
+
+class EntityOrder(Order):
+    def __init__(self, by, vtype, keyword):
+        self.by, self.vtype, self.keyword = by, vtype, keyword
+
+
+class EntityFetch(FetchEntity):
+    def __init__(self, operand):
+        self.operand = operand
+
+
+class EntityAfter(AfterTuple):
+    def __init__(self, values):
+        self.values = values
+
+
+class Query:
+    """A statement query made of the given joins and elements."""
+
+    target = Statement
+
+    def __init__(self, joins, elements, limit=10):
+        self.joins = {e.key: e for e in joins}
+        self.elements = elements
+        self.limit = limit
+        self.seen_values = set()
+
+    def get_elements(self, cls):
+        return [e for e in self.elements if isinstance(e, cls)]
+
+
+def new_statement(*triple):
+    return Statement(uuid.uuid4(), triple=triple or None)
@@ -0,0 +1,45 @@
+import datetime
+import os
+
+import pytest
+
+from sqlalchemy import BigInteger, DateTime, LargeBinary, bindparam
+from sqlalchemy.sql import select
+
+from qdserver.storage.digest import (
+    file_digest,
+    path_bucket,
+    sql_file_digest,
+    sql_path_bucket,
+)
+
+
+@pytest.mark.parametrize(
+    "size, mtime",
+    [
+        (1234, datetime.datetime(2020, 5, 17, 13, 45, 12, 345678)),
+        (0, datetime.datetime(1969, 12, 31, 23, 59, 59, 999999)),
+        (None, None),
+    ],
+)
+def test_sql_digest_matches_python(db, size, mtime):
+    path = "dir/fïle.txt".encode("utf-8")
+    handle = os.urandom(32)
+    params = {
+        "path": bindparam("path", path, type_=LargeBinary),
+        "handle": bindparam("handle", handle, type_=LargeBinary),
+        "size": bindparam("size", size, type_=BigInteger),
+        "mtime": bindparam("mtime", mtime, type_=DateTime),
+    }
+    row = db.execute(
+        select(
+            [
+                sql_file_digest(
+                    params["path"], params["handle"], params["size"], params["mtime"]
+                ),
+                sql_path_bucket(params["path"]),
+            ]
+        )
+    ).first()
+    assert row[0] == file_digest(path, handle, size, mtime)
+    assert row[1] == path_bucket(path)
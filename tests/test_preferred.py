@@ -0,0 +1,83 @@
+from qdserver.repository import PGRepository
+
+from .queries import (
+    EQ,
+    Entity,
+    EntityFilter,
+    EntityOrder,
+    EntityPrefer,
+    Query,
+    new_statement,
+)
+
+
+def test_filter_through_preferred_entity(db):
+    """A filter on an entity joined through a preferred one applies first.
+
+    The subject has two candidates for its preferred value. Only the one that
+    is not preferred has the filtered value, so the subject matches.
+    """
+    subject, p, q = new_statement(), new_statement(), new_statement()
+    candidates = [new_statement(), new_statement()]
+    PGRepository(db).fill_ids([p, q], allow_create=True)
+    source = (p.id, "s", "max")
+
+    repo = PGRepository(db, preferred_sources=frozenset([source]))
+    repo.create_statements([new_statement(subject, p, c) for c in candidates])
+    not_preferred = min(candidates, key=lambda c: c.id)
+    repo.create_statements([new_statement(not_preferred, q, 5)])
+
+    main = Entity("main")
+    by_p = Entity("p", main, [p])
+    by_q = Entity("q", by_p, [q])
+    query = Query(
+        [main, by_p, by_q],
+        [EntityFilter(by_q, EQ, 5), EntityPrefer(by_p, "s", "max")],
+    )
+
+    repos = [
+        PGRepository(db),
+        PGRepository(db, preferred_sources=frozenset([source])),
+    ]
+    results = [repo.run_query(query)[0] for repo in repos]
+    assert [s.handle for s in results[0]] == [subject.handle]
+    assert [s.handle for s in results[1]] == [subject.handle]
+
+
+def test_page_through_preferred_order(db):
+    """Ordering by a preferred value pages the same with and without cursors.
+
+    With preferred_value the cursor condition applies before the results are
+    collected, without it only afterwards. Both give every subject once, in
+    the order of its preferred value.
+    """
+    p = new_statement()
+    PGRepository(db).fill_ids([p], allow_create=True)
+    source = (p.id, "s", "max")
+
+    repo = PGRepository(db, preferred_sources=frozenset([source]))
+    subjects = [new_statement() for i in range(3)]
+    preferred = {}
+    for subject in subjects:
+        candidates = [new_statement(), new_statement()]
+        repo.create_statements([new_statement(subject, p, c) for c in candidates])
+        preferred[subject.handle] = max(c.id for c in candidates)
+    expected = sorted(preferred, key=preferred.get)
+
+    main = Entity("main")
+    by_p = Entity("p", main, [p])
+    query = Query(
+        [main, by_p],
+        [EntityPrefer(by_p, "s", "max"), EntityOrder(by_p, "s", "asc")],
+        limit=1,
+    )
+
+    for repo in [
+        PGRepository(db),
+        PGRepository(db, preferred_sources=frozenset([source])),
+    ]:
+        handles, cursor, more = [], None, True
+        while more:
+            results, more, cursor, statements, files = repo.run_query(query, cursor)
+            handles.extend(s.handle for s in results)
+        assert handles == expected
@@ -0,0 +1,102 @@
+import os
+import uuid
+
+import pytest
+
+from sqlalchemy.sql import select
+
+from queryduck.types import Blob, Statement
+
+from qdserver.models import blob_table, statement_table
+from qdserver.repository import PGRepository
+
+from .queries import (
+    EQ,
+    Entity,
+    EntityAfter,
+    EntityFetch,
+    EntityFilter,
+    EntityOrder,
+    Query,
+    new_statement,
+)
+
+
+@pytest.mark.parametrize("bulk_threshold", [1000, 0])
+def test_repost_blob_object_as_string(db, bulk_threshold):
+    subject, predicate = new_statement(), new_statement()
+    blob = Blob(handle=os.urandom(32))
+    handle = uuid.uuid4()
+
+    repo = PGRepository(db, bulk_threshold=bulk_threshold)
+    repo.create_statements([Statement(handle, triple=(subject, predicate, blob))])
+    has_statements = select([blob_table.c.has_statements]).where(
+        blob_table.c.id == blob.id
+    )
+    assert db.execute(has_statements).scalar()
+
+    # a new repository, like a later request, doesn't know the handle is saved
+    repo = PGRepository(db, bulk_threshold=bulk_threshold)
+    subject, predicate = Statement(subject.handle), Statement(predicate.handle)
+    repo.create_statements([Statement(handle, triple=(subject, predicate, "text"))])
+    row = db.execute(
+        select([statement_table]).where(statement_table.c.handle == handle)
+    ).first()
+    assert row["object_blob_id"] is None
+    assert row["object_string"] == "text"
+    assert not db.execute(has_statements).scalar()
+
+
+def test_fetch_several_entities(db):
+    subject, p, q = new_statement(), new_statement(), new_statement()
+    repo = PGRepository(db)
+    repo.fill_ids([subject, p, q], allow_create=True)
+    by_p = new_statement(subject, p, new_statement())
+    by_q = new_statement(subject, q, new_statement())
+    repo.create_statements([by_p, by_q])
+
+    main = Entity("main")
+    fetch_p = Entity("p", main, [p])
+    fetch_q = Entity("q", main, [q])
+    query = Query(
+        [main, fetch_p, fetch_q],
+        [
+            EntityFilter(main, EQ, subject),
+            EntityFetch(fetch_p),
+            EntityFetch(fetch_q),
+        ],
+    )
+    query.seen_values = {subject}
+
+    repo = PGRepository(db)
+    results, more, cursor, statements, files = repo.run_query(query)
+    assert [s.handle for s in results] == [subject.handle]
+    assert {s.handle for s in statements} == {
+        subject.handle,
+        by_p.handle,
+        by_q.handle,
+    }
+
+
+def test_ordered_query_after(db):
+    subject, p = new_statement(), new_statement()
+    repo = PGRepository(db)
+    repo.fill_ids([subject, p], allow_create=True)
+    numbered = [new_statement(subject, p, i) for i in (3, 1, 2, 0)]
+    repo.create_statements(numbered)
+
+    values = {s.handle: None for s in (subject, p)}
+    values.update((s.handle, s.triple[2]) for s in numbered)
+    after = sorted(values)[2]
+    expected = sorted(
+        (h for h in values if h > after),
+        key=lambda h: (values[h] is None, values[h], h),
+    )
+
+    main = Entity("main")
+    query = Query(
+        [main], [EntityOrder(main, "i", "asc"), EntityAfter([Statement(after)])]
+    )
+    results, more, cursor, statements, files = PGRepository(db).run_query(query)
+    assert [s.handle for s in results] == expected
+    assert not more